@@ -0,0 +1,394 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import aiohttp
+from models import Database
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http', 'img')
+PASSWORD = 'bench'
+SCENARIOS = {}  # name -> (default weight, coroutine function(bench, user) returning the response status)
+
+
+def scenario(weight):
+    def register(function):
+        SCENARIOS[function.__name__] = (weight, function)
+        return function
+    return register
+
+
+def form(*fields):
+    data = aiohttp.FormData()
+    for name, value in fields:
+        data.add_field(name, value)
+    return data
+
+
+class Bench:
+    """Closed-loop load against a running app: every client takes a weighted random scenario, awaits
+    its response and takes the next one. The requests are those of the http/ smoke scripts, aimed at
+    users and recipes made during setup instead of fixed ids on the demo host"""
+
+    def __init__(self, url, seed):
+        self.url = url.rstrip('/')
+        self.random = random.Random(seed)
+        self.run_id = ''.join(self.random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(6))
+        self.users = []  # {'client': ClientSession, 'nickname': ..., 'recipe_id': own recipe}
+        self.recipe_ids = []
+        self.user_ids = []
+        self.next_cursor = ''
+        self.created = 0
+        self.images = [open(os.path.join(IMAGES_DIR, name), 'rb').read() for name in sorted(os.listdir(IMAGES_DIR))] \
+            if os.path.isdir(IMAGES_DIR) else []
+
+    async def request(self, user, method, path, data=None):
+        async with user['client'].request(method, self.url + path, data=data) as response:
+            body = await response.read()
+            if response.content_type == 'application/json' and body:
+                user['last'] = json.loads(body)
+            return response.status
+
+    def recipe_form(self, title, image):
+        fields = [
+            ('recipe_title', title),
+            ('recipe_description', 'benchmark recipe'),
+            ('recipe_type', self.random.choice(['soup', 'drink', 'salad', 'other'])),
+            ('recipe_hashtag', self.random.choice(['simple', 'meat', 'bread'])),
+            ('recipe_step_1', 'mix'),
+            ('recipe_step_2', 'serve'),
+        ]
+        data = form(*fields)
+        if image and self.images:
+            data.add_field('recipe_image', self.random.choice(self.images), filename='image')
+        return data
+
+    async def setup(self, users, images):
+        for number in range(users):
+            nickname = 'bench {0} {1}'.format(self.run_id, number)
+            user = {'nickname': nickname,
+                    'client': aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))}
+            self.users.append(user)
+            await self.request(user, 'PUT', '/signin', form(('nickname', nickname), ('password', PASSWORD)))
+            status = await self.request(user, 'POST', '/auth', form(('nickname', nickname), ('password', PASSWORD)))
+            if status != 200:
+                raise RuntimeError('could not log in {0}: {1}'.format(nickname, user.get('last')))
+            await self.request(user, 'PUT', '/recipes/create', self.recipe_form(nickname, images))
+        user = self.users[0]
+        await self.request(user, 'POST', '/recipes/explore?from=0&to=1000',
+                           form(('title_filter', 'bench ' + self.run_id)))
+        own = {item['title']: item['recipe_id'] for item in user['last'].get('collection', [])}
+        for user in self.users:
+            user['recipe_id'] = own.get(user['nickname'])
+        await self.request(user, 'POST', '/recipes/explore?from=0&to=500')
+        items = user['last'].get('collection', [])
+        self.recipe_ids = [item['recipe_id'] for item in items]
+        self.user_ids = sorted({item['author_id'] for item in items})
+        if not self.recipe_ids:
+            raise RuntimeError('no recipes to read after setup')
+
+    async def close(self):
+        for user in self.users:
+            await user['client'].close()
+
+    async def client(self, scenarios, weights, started, warmup, deadline, samples):
+        while time.monotonic() < deadline:
+            name = self.random.choices(scenarios, weights)[0]
+            user = self.random.choice(self.users)
+            began = time.monotonic()
+            try:
+                status = await SCENARIOS[name][1](self, user)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                status = 'error'
+            if began - started >= warmup and status != 'skipped':
+                samples.setdefault(name, []).append((time.monotonic() - began, status))
+
+
+@scenario(25)
+async def explore(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10')
+
+
+@scenario(5)
+async def explore_next_page(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=10&to=20')
+
+
+@scenario(10)
+async def explore_by_likes(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=20', form(('sort_by', 'likes')))
+
+
+@scenario(5)
+async def explore_by_cursor(bench, user):
+    status = await bench.request(user, 'POST', '/recipes/explore?cursor={0}&limit=10'.format(bench.next_cursor),
+                                 form(('sort_by', 'likes')))
+    bench.next_cursor = (user.get('last') or {}).get('next_cursor') or ''
+    return status
+
+
+@scenario(5)
+async def explore_by_type(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(
+        ('sort_by', 'date_descending'), ('type_filter', 'drink'), ('type_filter', 'other')))
+
+
+@scenario(5)
+async def explore_by_hashtag(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(
+        ('sort_by', 'title'), ('hashtag_filter', 'meat'), ('hashtag_filter', 'bread')))
+
+
+@scenario(5)
+async def explore_by_name(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(('title_filter', 'bench')))
+
+
+@scenario(3)
+async def explore_by_author(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(
+        ('sort_by', 'title'), ('author_filter', 'bench')))
+
+
+@scenario(2)
+async def explore_by_image(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(
+        ('sort_by', 'title'), ('image_filter', 'on')))
+
+
+@scenario(3)
+async def explore_complex(bench, user):
+    return await bench.request(user, 'POST', '/recipes/explore?from=0&to=10', form(
+        ('sort_by', 'likes'), ('type_filter', 'soup'), ('type_filter', 'drink'), ('hashtag_filter', 'simple')))
+
+
+@scenario(2)
+async def facets(bench, user):
+    return await bench.request(user, 'GET', '/recipes/facets')
+
+
+@scenario(15)
+async def get_recipe(bench, user):
+    return await bench.request(user, 'GET', '/recipes/{0}'.format(bench.random.choice(bench.recipe_ids)))
+
+
+@scenario(5)
+async def recipe_image(bench, user):
+    return await bench.request(user, 'GET', '/recipes/{0}/image?size=small'.format(
+        bench.random.choice(bench.recipe_ids)))
+
+
+@scenario(3)
+async def profile(bench, user):
+    return await bench.request(user, 'GET', '/profile/{0}'.format(bench.random.choice(bench.user_ids)))
+
+
+@scenario(3)
+async def peoples(bench, user):
+    return await bench.request(user, 'POST', '/peoples', form(('sort_by', 'likes_total')))
+
+
+@scenario(3)
+async def favorites(bench, user):
+    return await bench.request(user, 'GET', '/profile/{0}/favorites'.format(bench.random.choice(bench.user_ids)))
+
+
+@scenario(3)
+async def profile_recipes(bench, user):
+    return await bench.request(user, 'GET', '/profile/{0}/recipes?sort_by=likes'.format(
+        bench.random.choice(bench.user_ids)))
+
+
+@scenario(8)
+async def like(bench, user):
+    recipe_id = bench.random.choice(bench.recipe_ids)
+    return await bench.request(user, 'POST', '/recipes/{0}/{1}'.format(
+        recipe_id, bench.random.choice(['like', 'unlike'])))
+
+
+@scenario(1)
+async def create(bench, user):
+    bench.created += 1
+    title = 'bench {0} created {1}'.format(bench.run_id, bench.created)
+    return await bench.request(user, 'PUT', '/recipes/create', bench.recipe_form(title, True))
+
+
+@scenario(0)
+async def create_batch(bench, user):
+    recipes = []
+    for _ in range(10):
+        bench.created += 1
+        recipes.append({'recipe_title': 'bench {0} created {1}'.format(bench.run_id, bench.created),
+                        'recipe_description': 'benchmark recipe', 'recipe_hashtag': ['simple'],
+                        'recipe_step_1': 'mix', 'recipe_step_2': 'serve'})
+    async with user['client'].put(bench.url + '/recipes/create-batch', json={'recipes': recipes}) as response:
+        await response.read()
+        return response.status
+
+
+@scenario(1)
+async def update(bench, user):
+    if not user.get('recipe_id'):
+        return 'skipped'
+    return await bench.request(user, 'PUT', '/recipes/{0}/update'.format(user['recipe_id']), form(
+        ('recipe_description', 'updated {0}'.format(time.time()))))
+
+
+@scenario(1)
+async def auth(bench, user):
+    return await bench.request(user, 'POST', '/auth', form(('nickname', user['nickname']), ('password', PASSWORD)))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(int(fraction * len(sorted_values)), len(sorted_values) - 1)], 3)
+
+
+def summarize(latencies_statuses, seconds):
+    latencies = sorted(latency * 1000 for latency, status in latencies_statuses)
+    statuses = {}
+    for latency, status in latencies_statuses:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(latencies),
+        'errors': sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 500),
+        'statuses': statuses,
+        'rps': round(len(latencies) / seconds, 2),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else None,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+    }
+
+
+def parse_weights(text):
+    weights = {name: weight for name, (weight, function) in SCENARIOS.items()}
+    for item in filter(None, (text or '').split(',')):
+        name, weight = item.split('=')
+        if name not in SCENARIOS:
+            raise SystemExit('unknown scenario {0}, one of: {1}'.format(name, ', '.join(SCENARIOS)))
+        weights[name] = float(weight)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as client:
+        while True:
+            try:
+                async with client.get(url + '/favicon.ico') as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('app at {0} did not start in {1} seconds'.format(url, timeout))
+            await asyncio.sleep(0.5)
+
+
+async def run(args):
+    weights = parse_weights(args.weights)
+    bench = Bench(args.url, args.seed)
+    await wait_ready(bench.url, args.start_timeout)
+    try:
+        await bench.setup(args.users, not args.no_images)
+        samples = {}
+        started = time.monotonic()
+        deadline = started + args.warmup + args.duration
+        await asyncio.gather(*[
+            bench.client(list(weights), list(weights.values()), started, args.warmup, deadline, samples)
+            for _ in range(args.concurrency)])
+        seconds = time.monotonic() - started - args.warmup
+    finally:
+        await bench.close()
+    return {
+        'commit': commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {'url': args.url, 'workers': args.workers if args.start else None, 'concurrency': args.concurrency,
+                   'duration': args.duration, 'warmup': args.warmup, 'users': args.users, 'seed': args.seed,
+                   'weights': weights},
+        'total': summarize([sample for route in samples.values() for sample in route], seconds),
+        'routes': {name: summarize(route, seconds) for name, route in sorted(samples.items())},
+    }
+
+
+def start_app(port, workers, database):
+    environment = dict(os.environ, RS_PORT=str(port), RS_WORKERS=str(workers), RS_MONGO_DATABASE=database)
+    return subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run.py')],
+                            env=environment)
+
+
+def compare(before_file, after_file):
+    with open(before_file) as fp:
+        before = json.load(fp)
+    with open(after_file) as fp:
+        after = json.load(fp)
+    print('{0:22} {1:>18} {2:>18} {3:>18} {4:>18}'.format(
+        '{0} -> {1}'.format(before.get('commit'), after.get('commit')), 'rps', 'p50 ms', 'p95 ms', 'p99 ms'))
+    routes = [('total', before['total'], after['total'])] + [
+        (name, before['routes'].get(name), after['routes'][name]) for name in after['routes']]
+    for name, old, new in routes:
+        cells = []
+        for key in ['rps', 'p50_ms', 'p95_ms', 'p99_ms']:
+            if not old or old.get(key) in [None, 0] or new.get(key) is None:
+                cells.append('{0:>18}'.format(str(new.get(key))))
+            else:
+                cells.append('{0:>9.1f} ({1:+6.1f}%)'.format(new[key], (new[key] - old[key]) * 100.0 / old[key]))
+        print('{0:22} {1}'.format(name, ' '.join(cells)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='load benchmark of the app against a local mongod')
+    parser.add_argument('command', choices=['run', 'compare'],
+                        help='run: load the app and write results; compare: print the change between two results')
+    parser.add_argument('files', nargs='*', help='compare: results before and after')
+    parser.add_argument('--url', default='http://127.0.0.1:8100')
+    parser.add_argument('--start', action='store_true', help='start run.py on the port of --url and stop it after')
+    parser.add_argument('--workers', type=int, default=1, help='RS_WORKERS of the app started with --start')
+    parser.add_argument('--start-timeout', type=float, default=30)
+    parser.add_argument('--database', help='RS_MONGO_DATABASE of the app started with --start, kept after the run; '
+                                           'default a new database dropped after the run')
+    parser.add_argument('--concurrency', type=int, default=32, help='clients sending requests at the same time')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of load before measuring')
+    parser.add_argument('--users', type=int, default=20, help='users created for the run, each with one recipe')
+    parser.add_argument('--weights', help='name=weight,... overriding default weights, 0 disables; scenarios: ' +
+                        ', '.join('{0}={1:g}'.format(name, weight) for name, (weight, function) in SCENARIOS.items()))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-images', action='store_true', help='create recipes without images')
+    parser.add_argument('--output', help='results file, default benchmark-<commit>.json')
+    args = parser.parse_args()
+    if args.command == 'compare':
+        if len(args.files) != 2:
+            parser.error('compare needs two result files')
+        compare(*args.files)
+        sys.exit(0)
+    database = args.database or 'benchmark_{0}'.format(int(time.time()))
+    app = start_app(aiohttp.client.URL(args.url).port, args.workers, database) if args.start else None
+    try:
+        results = asyncio.get_event_loop().run_until_complete(run(args))
+    finally:
+        if app:
+            app.terminate()
+            app.wait()
+            if not args.database:
+                Database.client().drop_database(database)
+    output = args.output or 'benchmark-{0}.json'.format(results['commit'] or int(time.time()))
+    with open(output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print(json.dumps(results['total'], indent=2))
+    print('results written to {0}'.format(output))
@@ -0,0 +1,86 @@
+# encoding: utf-8
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key, default=None):
+        """value of an unexpired entry, without counting a hit or miss or moving it up"""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def filter_key(filter_opts):
+    """same string for equal mongo filters: keys sorted, $in lists sorted, regexes by pattern and flags"""
+    def normalize(value):
+        if isinstance(value, re.Pattern):
+            return {'$regex': value.pattern, '$flags': value.flags}
+        if isinstance(value, dict):
+            return {key: (sorted(item, key=str) if key == '$in' else normalize(item)) for key, item in value.items()}
+        if isinstance(value, list):
+            return [normalize(item) for item in value]
+        return value
+    return json.dumps(normalize(filter_opts), sort_keys=True, default=str)
+
+
+# total_recipes_count of explore by filter; cleared whenever recipes appear, disappear or change status
+recipes_count_cache = TTLCache(int(os.environ.get('RS_COUNT_CACHE_SIZE', '1024')),
+                               float(os.environ.get('RS_COUNT_CACHE_TTL', '30')))
+
+# status, isAdmin and nickname of logged in users by user_id, so protect needs no query per request;
+# entries of a user are dropped on lock, rename and delete, other processes see it after ttl
+users_auth_cache = TTLCache(int(os.environ.get('RS_AUTH_CACHE_SIZE', '10000')),
+                            float(os.environ.get('RS_AUTH_CACHE_TTL', '10')))
+
+# serialized explore responses by normalized query; cleared with the counts, so only likes_total can be stale
+# within ttl, pages sorted by likes are kept for the shorter RS_EXPLORE_CACHE_LIKES_TTL as likes reorder them
+explore_cache = TTLCache(int(os.environ.get('RS_EXPLORE_CACHE_SIZE', '1024')),
+                         float(os.environ.get('RS_EXPLORE_CACHE_TTL', '10')))
+EXPLORE_LIKES_TTL = float(os.environ.get('RS_EXPLORE_CACHE_LIKES_TTL', '2'))
+
+
+def recipes_changed():
+    """a recipe appeared, disappeared or changed status or content"""
+    recipes_count_cache.clear()
+    explore_cache.clear()
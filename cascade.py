@@ -0,0 +1,204 @@
+# encoding: utf-8
+import os
+import time
+import asyncio
+import collections
+from pymongo import UpdateOne, ReturnDocument
+from models import Database
+from images import ImageStore
+from leaderboard import Leaderboard
+
+
+class Cascade:
+    """Removes what points to a deleted recipe or user in batches, as background jobs stored in the
+    cascades collection. Every batch is idempotent, so an interrupted job is resumed where it stopped
+    by whichever process takes its lease next. A process stopping hands its jobs back at once, jobs of a
+    crashed one are picked up by the others, which look for expired leases every LEASE seconds. A job
+    failing MAX_ATTEMPTS times is marked failed and left alone. A job crashed between deleting a batch of
+    a user's likes and decrementing the liked recipes may leave those counters one batch too high"""
+    BATCH_SIZE = int(os.environ.get('RS_CASCADE_BATCH_SIZE', '1000'))
+    MAX_ATTEMPTS = int(os.environ.get('RS_CASCADE_MAX_ATTEMPTS', '5'))
+    LEASE = 60
+    _tasks = set()
+    _task = None
+
+    @staticmethod
+    def collection():
+        return Database.database().cascades
+
+    @staticmethod
+    async def run(function, *args):
+        return await Database.run(function, *args)
+
+    @staticmethod
+    async def submit(kind, target_id):
+        job = {'kind': kind, 'target_id': target_id, 'state': 'running', 'created': time.time(),
+               'updated': time.time(), 'lease_until': 0, 'progress': {'likes': 0, 'recipes': 0}, 'attempts': 0}
+        await Cascade.run(Cascade.collection().insert_one, job)
+        Cascade.schedule(job['_id'])
+        return job['_id']
+
+    @staticmethod
+    def schedule(job_id):
+        task = asyncio.ensure_future(Cascade.process(job_id))
+        Cascade._tasks.add(task)
+        task.add_done_callback(Cascade._tasks.discard)
+
+    @staticmethod
+    async def start():
+        await Cascade.resume()
+        Cascade._task = asyncio.ensure_future(Cascade._run())
+
+    @staticmethod
+    async def _run():
+        while True:
+            await asyncio.sleep(Cascade.LEASE)
+            try:
+                await Cascade.resume()
+            except Exception as e:
+                print('cascade resume failed: {0}'.format(e))
+
+    @staticmethod
+    async def resume():
+        """schedules running jobs nobody holds the lease of"""
+        jobs = await Cascade.run(lambda: list(Cascade.collection().find(
+            {'state': 'running', 'lease_until': {'$lt': time.time()}}, projection=['_id'])))
+        for job in jobs:
+            Cascade.schedule(job['_id'])
+
+    @staticmethod
+    def take_lease(job_id):
+        now = time.time()
+        return Cascade.collection().find_one_and_update(
+            {'_id': job_id, 'state': 'running', 'lease_until': {'$lt': now}},
+            {'$set': {'lease_until': now + Cascade.LEASE, 'updated': now}},
+            return_document=ReturnDocument.AFTER)
+
+    @staticmethod
+    def release_lease(job_id):
+        Cascade.collection().update_one({'_id': job_id, 'state': 'running'}, {'$set': {'lease_until': 0}})
+
+    @staticmethod
+    def report(job_id, progress_field, done):
+        now = time.time()
+        Cascade.collection().update_one({'_id': job_id}, {
+            '$inc': {'progress.' + progress_field: done},
+            '$set': {'lease_until': now + Cascade.LEASE, 'updated': now}})
+
+    @staticmethod
+    def record_failure(job_id, error):
+        """counts a failed attempt of a job, True if it is to be retried; failed after MAX_ATTEMPTS"""
+        now = time.time()
+        job = Cascade.collection().find_one_and_update(
+            {'_id': job_id, 'state': 'running'}, {'$inc': {'attempts': 1}, '$set': {'error': error, 'updated': now}},
+            projection=['attempts'], return_document=ReturnDocument.AFTER)
+        if not job:
+            return False
+        if job['attempts'] < Cascade.MAX_ATTEMPTS:
+            return True
+        Cascade.collection().update_one({'_id': job_id}, {'$set': {'state': 'failed', 'lease_until': 0}})
+        return False
+
+    @staticmethod
+    async def process(job_id):
+        job = None
+        try:
+            job = await Cascade.run(Cascade.take_lease, job_id)
+            if not job:  # finished or being processed by another process
+                return
+            if job['kind'] == 'user':
+                taken_back = 0
+                while True:
+                    done = await Cascade.run(Cascade.user_likes_batch, job['target_id'])
+                    if not done:
+                        break
+                    taken_back += done
+                    await Cascade.run(Cascade.report, job_id, 'likes', done)
+                if taken_back:  # authors' likes_total were decremented past the counter buffer and its listeners
+                    Leaderboard.schedule_rebuild()
+                while True:
+                    done = await Cascade.run(Cascade.user_recipe_step, job['target_id'])
+                    if not done:
+                        break
+                    await Cascade.run(Cascade.report, job_id, *done)
+            else:
+                while True:
+                    done = await Cascade.run(Cascade.recipe_likes_batch, job['target_id'])
+                    if not done:
+                        break
+                    await Cascade.run(Cascade.report, job_id, 'likes', done)
+            await Cascade.run(Cascade.collection().update_one, {'_id': job_id}, {
+                '$set': {'state': 'done', 'updated': time.time(), 'lease_until': 0}})
+        except asyncio.CancelledError:  # shutdown, the job is resumed by the next process looking for one
+            if job:
+                await Cascade.run(Cascade.release_lease, job_id)
+            raise
+        except Exception as e:
+            if not await Cascade.run(Cascade.record_failure, job_id, str(e)):
+                print('cascade {0} failed, giving up: {1}'.format(job_id, e))
+                return
+            print('cascade {0} failed, retrying once its lease expires: {1}'.format(job_id, e))
+            await asyncio.sleep(Cascade.LEASE)
+            Cascade.schedule(job_id)
+
+    @staticmethod
+    def recipe_likes_batch(recipe_id):
+        """pulls the recipe from favorites of one batch of its likers and drops their likes"""
+        likes = list(Database.likes_collection().find(
+            {'recipe_id': recipe_id}, projection=['user_id'], limit=Cascade.BATCH_SIZE))
+        if not likes:
+            return 0
+        user_ids = [like['user_id'] for like in likes]
+        Database.users_collection().update_many({'user_id': {'$in': user_ids}}, {'$pull': {'favorites': recipe_id}})
+        Database.likes_collection().delete_many({'recipe_id': recipe_id, 'user_id': {'$in': user_ids}})
+        return len(likes)
+
+    @staticmethod
+    def user_likes_batch(user_id):
+        """drops one batch of likes the user gave and takes them back from recipes and their authors"""
+        likes = list(Database.likes_collection().find(
+            {'user_id': user_id}, projection=['recipe_id', 'author_id'], limit=Cascade.BATCH_SIZE))
+        if not likes:
+            return 0
+        Database.likes_collection().delete_many(
+            {'user_id': user_id, 'recipe_id': {'$in': [like['recipe_id'] for like in likes]}})
+        Database.recipes_collection().bulk_write([
+            UpdateOne({'recipe_id': like['recipe_id']}, {'$inc': {'likes_total': -1}}) for like in likes
+        ], ordered=False)
+        authors = collections.Counter(like.get('author_id') for like in likes)
+        Database.users_collection().bulk_write([
+            UpdateOne({'user_id': author_id}, {'$inc': {'likes_total': -count}})
+            for author_id, count in authors.items()
+        ], ordered=False)
+        return len(likes)
+
+    @staticmethod
+    def user_recipe_step(user_id):
+        """one batch of likes of one recipe of the user, or the recipe itself once it has no likes left"""
+        recipe = Database.recipes_collection().find_one({'author_id': user_id}, projection=['recipe_id', 'image_id'])
+        if not recipe:
+            return None
+        done = Cascade.recipe_likes_batch(recipe['recipe_id'])
+        if done:
+            return 'likes', done
+        Database.recipes_collection().delete_one({'recipe_id': recipe['recipe_id']})
+        if recipe.get('image_id'):
+            ImageStore.release(recipe['image_id'])
+        return 'recipes', 1
+
+    @staticmethod
+    def jobs(limit):
+        """running jobs and the most recent finished ones"""
+        return list(Cascade.collection().find({}, projection={'lease_until': False}, limit=limit,
+                                              sort=[('state', -1), ('updated', -1)]))
+
+    @staticmethod
+    async def shutdown():
+        if Cascade._task:
+            Cascade._task.cancel()
+            await asyncio.gather(Cascade._task, return_exceptions=True)
+            Cascade._task = None
+        for task in list(Cascade._tasks):
+            task.cancel()
+        if Cascade._tasks:
+            await asyncio.gather(*Cascade._tasks, return_exceptions=True)
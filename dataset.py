@@ -0,0 +1,165 @@
+# encoding: utf-8
+import os
+import sys
+import random
+import bisect
+import argparse
+import itertools
+from array import array
+from models import Database, IdAllocator, User, Recipe
+from images import ImageStore
+from thumbnails import Thumbnails, render_thumbnails
+from indexes import apply_indexes
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http', 'img')
+COLLECTIONS = ['users', 'recipes', 'likes', 'counters', 'cascades', 'images.files', 'images.chunks']
+DAY = 24 * 60 * 60
+
+ADJECTIVES = ['fresh', 'spicy', 'sweet', 'crispy', 'creamy', 'roasted', 'grilled', 'smoked', 'baked', 'green',
+              'quick', 'homemade', 'rustic', 'golden', 'tangy', 'hearty', 'light', 'classic', 'summer', 'winter']
+DISHES = ['soup', 'salad', 'omelette', 'burger', 'pizza', 'pasta', 'pie', 'stew', 'curry', 'sandwich', 'salmon',
+          'chicken', 'risotto', 'pancakes', 'lemonade', 'smoothie', 'quinoa', 'noodles', 'tacos', 'cake']
+NAMES = ['anna', 'boris', 'chen', 'dmitry', 'elena', 'farid', 'greta', 'hugo', 'ivan', 'julia', 'kofi', 'lena',
+         'maria', 'nikolai', 'olga', 'pedro', 'quinn', 'rosa', 'sergey', 'tanya', 'umar', 'vera', 'wei', 'yuki']
+HASHTAGS = ['simple', 'meat', 'bread', 'vegan', 'vegetarian', 'spicy', 'healthy', 'breakfast', 'dinner', 'lunch',
+            'kids', 'party', 'fish', 'cheese', 'glutenfree', 'lowcarb', 'budget', 'festive', 'grill', 'oven',
+            'fast', 'sweet', 'chocolate', 'fruit', 'nuts', 'rice', 'potato', 'eggs', 'asian', 'italian']
+TYPES = ['other', 'drink', 'salad', 'first course', 'second course', 'soup', 'dessert']
+STEPS = ['wash and chop the vegetables', 'heat the oil in a pan', 'mix the dry ingredients', 'whisk the eggs',
+         'bring the water to a boil', 'season with salt and pepper', 'bake for 20 minutes', 'stir until smooth',
+         'let it rest for 10 minutes', 'serve warm', 'garnish with herbs', 'chill before serving']
+
+
+def zipf_cumulative(size, exponent, rng):
+    """cumulative weights of size items whose popularity falls as rank ** -exponent, ranks shuffled
+    so popular items are spread over ids and dates"""
+    ranks = list(range(1, size + 1))
+    rng.shuffle(ranks)
+    return list(itertools.accumulate(rank ** -exponent for rank in ranks))
+
+
+def pick(cumulative, rng):
+    return bisect.bisect(cumulative, rng.random() * cumulative[-1])
+
+
+def insert_batches(collection, documents, batch_size):
+    done = 0
+    for batch in iter(lambda: list(itertools.islice(documents, batch_size)), []):
+        collection.insert_many(batch, ordered=False)
+        done += len(batch)
+        if done % (batch_size * 100) == 0:
+            print('{0}: {1} documents inserted'.format(collection.name, done))
+    print('{0}: {1} documents inserted'.format(collection.name, done))
+
+
+def generate(args):
+    """Writes args.users users, args.recipes recipes and their likes with insert_many. Everything,
+    dates included, follows from args.seed, so the same arguments give the same database"""
+    rng = random.Random(args.seed)
+    first_id, until = IdAllocator.FIRST_ID, args.until
+    crypt_password = User.encrypt_password(args.password)
+
+    # who wrote what: a few prolific authors, most users with a recipe or none
+    authors = zipf_cumulative(args.users, args.author_exponent, rng)
+    recipe_author = array('l', (pick(authors, rng) for _ in range(args.recipes)))
+    recipe_date = array('d', (until - rng.random() * args.days * DAY for _ in range(args.recipes)))
+
+    # who liked what: activity of users and popularity of recipes both follow a power law; a recipe drawn
+    # twice for one user is liked once, so popular recipes end with a bit fewer likes than drawn
+    popularity = zipf_cumulative(args.recipes, args.like_exponent, rng)
+    favorites = []
+    recipe_likes = array('l', bytes(array('l').itemsize * args.recipes))
+    for _ in range(args.users):
+        wanted = min(args.recipes, int(rng.paretovariate(1.5) * args.likes_per_user / 3))
+        liked = sorted({pick(popularity, rng) for _ in range(wanted)})
+        for recipe in liked:
+            recipe_likes[recipe] += 1
+        favorites.append(liked)
+    likes_received = array('l', bytes(array('l').itemsize * args.users))
+    recipes_by_author = [[] for _ in range(args.users)]
+    for recipe, author in enumerate(recipe_author):
+        likes_received[author] += recipe_likes[recipe]
+        recipes_by_author[author].append(first_id + recipe)
+    nicknames = ['{0} {1} {2}'.format(rng.choice(NAMES), rng.choice(ADJECTIVES), user)
+                 for user in range(args.users)]
+    locked_users = set(rng.sample(range(args.users), int(args.users * args.locked)))
+    locked_recipes = set(rng.sample(range(args.recipes), int(args.recipes * args.locked)))
+
+    image_ids = []
+    if args.images and os.path.isdir(IMAGES_DIR):
+        for name in sorted(os.listdir(IMAGES_DIR)):
+            with open(os.path.join(IMAGES_DIR, name), 'rb') as fp:
+                image_ids.append(ImageStore.put(fp.read()))
+
+    def users():
+        for user in range(args.users):
+            yield User(user_id=first_id + user, nickname=nicknames[user], crypt_password=crypt_password,
+                       status='locked' if user in locked_users else 'active',
+                       favorites=[first_id + recipe for recipe in favorites[user]],
+                       recipes=recipes_by_author[user], likes_total=likes_received[user]).__dict__
+
+    hashtag_weights = list(itertools.accumulate(rank ** -1.0 for rank in range(1, len(HASHTAGS) + 1)))
+
+    def recipes():
+        for recipe in range(args.recipes):
+            author = recipe_author[recipe]
+            hashtags = sorted({HASHTAGS[pick(hashtag_weights, rng)] for _ in range(rng.randint(0, 3))})
+            with_image = image_ids and rng.random() < args.images
+            yield Recipe(
+                recipe_id=first_id + recipe, author_id=first_id + author, author=nicknames[author],
+                date=recipe_date[recipe],
+                title='{0} {1} {2}'.format(rng.choice(ADJECTIVES), rng.choice(DISHES), recipe),
+                type=rng.choice(TYPES), hashtags=hashtags,
+                description='{0} {1} for {2} people'.format(
+                    rng.choice(ADJECTIVES), rng.choice(DISHES), rng.randint(1, 8)),
+                steps=rng.sample(STEPS, rng.randint(2, 6)),
+                status='locked' if recipe in locked_recipes else 'active',
+                likes_total=recipe_likes[recipe],
+                image_id=rng.choice(image_ids) if with_image else None).__dict__
+
+    def likes():
+        for user in range(args.users):
+            for recipe in favorites[user]:
+                yield {'user_id': first_id + user, 'recipe_id': first_id + recipe,
+                       'author_id': first_id + recipe_author[recipe],
+                       'date': recipe_date[recipe] + rng.random() * (until - recipe_date[recipe])}
+
+    insert_batches(Database.users_collection(), users(), args.batch_size)
+    insert_batches(Database.recipes_collection(), recipes(), args.batch_size)
+    insert_batches(Database.likes_collection(), likes(), args.batch_size)
+    for image_id in image_ids:  # sets thumbnails of every recipe showing the image
+        try:
+            Thumbnails.store(image_id, render_thumbnails(Thumbnails.read(image_id), ImageStore.THUMBNAIL_SIZES))
+        except Exception as e:
+            print('thumbnails for image {0} failed: {1}'.format(image_id, e))
+    for name, count in [('users', args.users), ('recipes', args.recipes)]:
+        # ids the app hands out next start after the generated ones
+        Database.counters_collection().update_one(
+            {'_id': name}, {'$max': {'next': first_id + count}}, upsert=True)
+    apply_indexes()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='synthetic users, recipes and likes for load tests')
+    parser.add_argument('command', choices=['generate'])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--recipes', type=int, default=1000000)
+    parser.add_argument('--likes-per-user', type=float, default=20, help='mean number of recipes a user likes')
+    parser.add_argument('--like-exponent', type=float, default=1.0, help='power law exponent of recipe popularity')
+    parser.add_argument('--author-exponent', type=float, default=1.0, help='power law exponent of recipes per author')
+    parser.add_argument('--images', type=float, default=0.3, help='share of recipes with one of the http/img images')
+    parser.add_argument('--locked', type=float, default=0.01, help='share of locked users and of locked recipes')
+    parser.add_argument('--days', type=float, default=365, help='recipes are dated over this many days')
+    parser.add_argument('--until', type=float, default=1640995200.0, help='timestamp of the newest recipe')
+    parser.add_argument('--password', default='password', help='password of every generated user')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--drop', action='store_true', help='drop the collections of the app first')
+    args = parser.parse_args()
+    database = Database.database()
+    if args.drop:
+        for name in COLLECTIONS:
+            database.drop_collection(name)
+    elif any(database[name].estimated_document_count() for name in ['users', 'recipes', 'likes']):
+        sys.exit('the database is not empty, generated ids would collide with existing ones; use --drop')
+    generate(args)
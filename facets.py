@@ -0,0 +1,152 @@
+# encoding: utf-8
+import os
+import time
+import heapq
+import asyncio
+from models import Database
+from cache import TTLCache
+
+
+class Facets:
+    """Recipe counts per hashtag and per type of active recipes, and hashtags trending by recent likes,
+    for /recipes/facets.
+
+    Handlers report every recipe they create, change, delete or (un)like, so counts follow this process's
+    writes at once. A trending score is the number of likes of recipes with the hashtag, each weighted
+    0.5 ** (age / HALF_LIFE). Everything is recomputed from mongo every RECONCILE_INTERVAL seconds, which
+    brings in other processes' writes and mass changes such as deleted users' recipes"""
+    HALF_LIFE = float(os.environ.get('RS_TRENDING_HALF_LIFE', str(24 * 60 * 60)))
+    RECONCILE_INTERVAL = float(os.environ.get('RS_FACETS_RECONCILE', '300'))
+    WINDOW = 8  # half-lives of likes read by reconcile, older ones weigh less than 0.4%
+    _hashtags = {}  # hashtag -> active recipes
+    _types = {}  # type -> active recipes
+    _trending = {}  # hashtag -> [score, time of score]
+    _responses = TTLCache(16, float(os.environ.get('RS_FACETS_CACHE_TTL', '1')))
+    _task = None
+    _reconcile = None
+
+    @staticmethod
+    async def start():
+        await Facets.reconcile()
+        Facets._task = asyncio.ensure_future(Facets._run())
+
+    @staticmethod
+    async def _run():
+        while True:
+            await asyncio.sleep(Facets.RECONCILE_INTERVAL)
+            await Facets.reconcile()
+
+    @staticmethod
+    def load(now):
+        recipes = Database.recipes_collection()
+        active = [{'$match': {'status': 'active'}},
+                  {'$project': {'type': True, 'hashtags': {'$setUnion': [{'$ifNull': ['$hashtags', []]}, []]}}}]
+        hashtags = recipes.aggregate(active + [
+            {'$unwind': '$hashtags'},
+            {'$group': {'_id': '$hashtags', 'recipes': {'$sum': 1}}},
+        ], allowDiskUse=True)
+        types = recipes.aggregate(active + [{'$group': {'_id': '$type', 'recipes': {'$sum': 1}}}])
+        trending = Database.likes_collection().aggregate([
+            {'$match': {'date': {'$gte': now - Facets.WINDOW * Facets.HALF_LIFE}}},
+            {'$group': {'_id': '$recipe_id', 'score': {'$sum': {
+                '$pow': [0.5, {'$divide': [{'$subtract': [now, '$date']}, Facets.HALF_LIFE]}]}}}},
+            {'$lookup': {'from': recipes.name, 'localField': '_id', 'foreignField': 'recipe_id', 'as': 'recipe'}},
+            {'$unwind': '$recipe'},
+            {'$match': {'recipe.status': 'active'}},
+            {'$project': {'score': True, 'hashtags': {'$setUnion': [{'$ifNull': ['$recipe.hashtags', []]}, []]}}},
+            {'$unwind': '$hashtags'},
+            {'$group': {'_id': '$hashtags', 'score': {'$sum': '$score'}}},
+        ], allowDiskUse=True)
+        return ({item['_id']: item['recipes'] for item in hashtags}, {item['_id']: item['recipes'] for item in types},
+                {item['_id']: [item['score'], now] for item in trending})
+
+    @staticmethod
+    async def reconcile():
+        if not Facets._reconcile:  # one at a time, concurrent callers wait for the running one
+            Facets._reconcile = asyncio.ensure_future(Database.run(Facets.load, time.time()))
+            Facets._reconcile.add_done_callback(Facets._reconciled)
+        try:
+            await asyncio.shield(Facets._reconcile)
+        except Exception as e:  # the current counts are kept
+            print('facets reconcile failed: {0}'.format(e))
+
+    @staticmethod
+    def _reconciled(task):
+        Facets._reconcile = None
+        if not task.cancelled() and not task.exception():
+            Facets._hashtags, Facets._types, Facets._trending = task.result()
+            Facets._responses.clear()
+
+    @staticmethod
+    def schedule_reconcile():
+        if not Facets._reconcile:
+            asyncio.ensure_future(Facets.reconcile())
+
+    @staticmethod
+    def _count(recipe, delta):
+        if not recipe or recipe.get('status') != 'active':
+            return
+        for hashtag in set(recipe.get('hashtags') or []):
+            Facets._hashtags[hashtag] = Facets._hashtags.get(hashtag, 0) + delta
+            if Facets._hashtags[hashtag] <= 0:
+                del Facets._hashtags[hashtag]
+        recipe_type = recipe.get('type', 'other')
+        Facets._types[recipe_type] = Facets._types.get(recipe_type, 0) + delta
+        if Facets._types[recipe_type] <= 0:
+            del Facets._types[recipe_type]
+
+    @staticmethod
+    def added(recipe):
+        Facets._count(recipe, 1)
+
+    @staticmethod
+    def removed(recipe):
+        Facets._count(recipe, -1)
+
+    @staticmethod
+    def changed(old, new):
+        """old and new document of an updated or (un)locked recipe"""
+        Facets._count(old, -1)
+        Facets._count(new, 1)
+
+    @staticmethod
+    def liked(recipe, delta, date=None):
+        """delta likes made at date, now by default: an unlike takes back the weight its like has left"""
+        if recipe.get('status') != 'active':
+            return
+        now = time.time()
+        if date is not None:
+            delta *= 0.5 ** (max(now - date, 0.0) / Facets.HALF_LIFE)
+        for hashtag in set(recipe.get('hashtags') or []):
+            score = Facets._trending.setdefault(hashtag, [0.0, now])
+            score[0] = max(Facets.decayed(score, now) + delta, 0.0)
+            score[1] = now
+
+    @staticmethod
+    def decayed(score, now):
+        return score[0] * 0.5 ** ((now - score[1]) / Facets.HALF_LIFE)
+
+    @staticmethod
+    def top(limit):
+        """hashtags and types by recipes, hashtags by trending score; the limit most of each"""
+        cached = Facets._responses.get(limit)
+        if cached is None:
+            now = time.time()
+            trending = ((Facets.decayed(score, now), hashtag) for hashtag, score in Facets._trending.items())
+            cached = {
+                'hashtags': [{'hashtag': hashtag, 'recipes': recipes} for recipes, hashtag in heapq.nlargest(
+                    limit, ((recipes, hashtag) for hashtag, recipes in Facets._hashtags.items()))],
+                'types': [{'type': recipe_type, 'recipes': recipes} for recipe_type, recipes in
+                          sorted(Facets._types.items(), key=lambda item: -item[1])],
+                'trending': [{'hashtag': hashtag, 'score': round(score, 3)} for score, hashtag in
+                             heapq.nlargest(limit, trending) if score >= 0.001],
+            }
+            Facets._responses.set(limit, cached)
+        return cached
+
+    @staticmethod
+    async def shutdown():
+        if Facets._task:
+            Facets._task.cancel()
+            await asyncio.gather(Facets._task, return_exceptions=True)
+            Facets._task = None
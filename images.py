@@ -0,0 +1,129 @@
+# encoding: utf-8
+import re
+import hashlib
+import gridfs
+from gridfs.errors import FileExists
+from models import Database
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class ImageStore:
+    """Content-addressed image storage in GridFS; file _id is the sha256 of the image bytes,
+    so the same picture uploaded for several recipes is stored once"""
+    CHUNK_SIZE = 255 * 1024
+    THUMBNAIL_SIZES = {'small': 160, 'medium': 320, 'large': 640}
+    _fs = None
+    _SIGNATURES = [
+        (b'\x89PNG\r\n\x1a\n', 'image/png'),
+        (b'\xff\xd8\xff', 'image/jpeg'),
+        (b'GIF87a', 'image/gif'),
+        (b'GIF89a', 'image/gif'),
+        (b'BM', 'image/bmp'),
+    ]
+
+    @staticmethod
+    def fs():
+        if not ImageStore._fs:
+            ImageStore._fs = gridfs.GridFS(Database.database(), collection='images')
+        return ImageStore._fs
+
+    @staticmethod
+    def content_type(image_bytes):
+        if image_bytes[:4] == b'RIFF' and image_bytes[8:12] == b'WEBP':
+            return 'image/webp'
+        for signature, content_type in ImageStore._SIGNATURES:
+            if image_bytes.startswith(signature):
+                return content_type
+        return 'application/octet-stream'
+
+    @staticmethod
+    def thumbnail_id(image_id, size):
+        return '{0}.{1}'.format(image_id, size)
+
+    @staticmethod
+    def put(image_bytes, image_id=None):
+        image_id = image_id or hashlib.sha256(image_bytes).hexdigest()
+        if not ImageStore.fs().exists(image_id):
+            try:
+                ImageStore.fs().put(image_bytes, _id=image_id, chunk_size=ImageStore.CHUNK_SIZE,
+                                    content_type=ImageStore.content_type(image_bytes))
+            except FileExists:  # same image stored concurrently
+                pass
+        return image_id
+
+    @staticmethod
+    def put_upload(upload):
+        """stores an uploads.UploadedFile, read from its spool in chunks"""
+        if not ImageStore.fs().exists(upload.sha256):
+            content_type = ImageStore.content_type(upload.head(16))
+            try:
+                ImageStore.fs().put(upload.file, _id=upload.sha256, chunk_size=ImageStore.CHUNK_SIZE,
+                                    content_type=content_type)
+            except FileExists:
+                pass
+        return upload.sha256
+
+    @staticmethod
+    def open(image_id):
+        try:
+            return ImageStore.fs().get(image_id)
+        except gridfs.NoFile:
+            return None
+
+    @staticmethod
+    def release(image_id):
+        # images are shared between recipes with the same picture, drop only the last reference
+        if not Database.recipes_collection().count_documents({'image_id': image_id}, limit=1):
+            ImageStore.fs().delete(image_id)
+            for size in ImageStore.THUMBNAIL_SIZES:
+                ImageStore.fs().delete(ImageStore.thumbnail_id(image_id, size))
+
+    @staticmethod
+    async def run(function, *args):
+        return await Database.run(function, *args)
+
+    @staticmethod
+    async def put_upload_async(upload):
+        return await ImageStore.run(ImageStore.put_upload, upload)
+
+    @staticmethod
+    async def open_async(image_id):
+        return await ImageStore.run(ImageStore.open, image_id)
+
+    @staticmethod
+    async def release_async(image_id):
+        return await ImageStore.run(ImageStore.release, image_id)
+
+    @staticmethod
+    def parse_range(range_header, length):
+        """returns inclusive (start, end) of the requested bytes; only single ranges are honoured,
+        anything else is served whole"""
+        match = re.match(r'^bytes=(\d*)-(\d*)$', (range_header or '').strip())
+        if not match or not any(match.groups()):
+            return 0, length - 1
+        start, end = match.groups()
+        if not start:  # suffix range: last N bytes
+            start, end = max(length - int(end), 0), length - 1
+        else:
+            start, end = int(start), min(int(end), length - 1) if end else length - 1
+        if start >= length or start > end:
+            raise RangeNotSatisfiable
+        return start, end
+
+    @staticmethod
+    def image_reference(recipe):
+        if not recipe.get('image_id') and not recipe.get('image_bytes'):
+            return None
+        return {
+            'image_id': recipe.get('image_id'),
+            'url': '/recipes/{0}/image'.format(recipe.get('recipe_id')),
+            'thumbnails': ImageStore.thumbnail_references(recipe),
+        }
+
+    @staticmethod
+    def thumbnail_references(recipe):
+        return {size: '/recipes/{0}/image?size={1}'.format(recipe.get('recipe_id'), size)
+                for size in recipe.get('thumbnails') or []}
@@ -0,0 +1,153 @@
+# encoding: utf-8
+import sys
+import argparse
+import itertools
+import pymongo
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+from multidict import MultiDict
+from models import Database
+from validator import RequestValidator
+import schema
+
+ASC, DESC = pymongo.ASCENDING, pymongo.DESCENDING
+
+# every explore query carries status (admins get status $in [...]), so all recipe indexes start with it;
+# type/hashtags are the equality filters, then the sort of RequestValidator.sort_filter_options
+# with its recipe_id tiebreaker, which keyset cursors need to seek straight to the next page
+INDEXES = {
+    'users': [
+        IndexModel([('user_id', ASC)], unique=True),
+        IndexModel([('nickname', ASC)], unique=True),
+        IndexModel([('nickname_tokens', ASC)]),
+        IndexModel([('status', ASC), ('recipes_total', DESC)]),
+        IndexModel([('status', ASC), ('likes_total', DESC)]),
+    ],
+    'recipes': [
+        IndexModel([('recipe_id', ASC)], unique=True),
+        IndexModel([('title', ASC)], unique=True),
+        IndexModel([('author_id', ASC)]),
+        IndexModel([('image_id', ASC)]),
+        IndexModel([('status', ASC), ('title_tokens', ASC)]),
+    ] + [
+        IndexModel([('status', ASC)] + prefix + sort)
+        for prefix, sort in itertools.product(
+            [[], [('type', ASC)], [('hashtags', ASC)]],
+            [[('likes_total', DESC), ('recipe_id', DESC)], [('date', DESC), ('recipe_id', DESC)],
+             [('title', ASC), ('recipe_id', ASC)], [('recipe_id', ASC)]])
+    ] + [
+        # recipes of a profile, by each sort of /profile/{id}/recipes
+        IndexModel([('author_id', ASC), ('status', ASC)] + sort)
+        for sort in [[('likes_total', DESC), ('recipe_id', DESC)], [('date', DESC), ('recipe_id', DESC)],
+                     [('title', ASC), ('recipe_id', ASC)]]
+    ],
+    'cascades': [
+        IndexModel([('state', ASC), ('updated', DESC)]),
+    ],
+    'likes': [
+        IndexModel([('user_id', ASC), ('recipe_id', ASC)], unique=True),
+        IndexModel([('recipe_id', ASC), ('user_id', ASC)]),
+        IndexModel([('user_id', ASC), ('date', DESC), ('recipe_id', DESC)]),
+        IndexModel([('date', ASC)]),
+    ],
+}
+
+
+def apply_indexes():
+    """creates missing indexes; existing ones with the same keys and options are left as is"""
+    for collection_name, indexes in INDEXES.items():
+        collection = Database.database()[collection_name]
+        for index in indexes:
+            try:
+                collection.create_indexes([index])
+            except OperationFailure as e:  # e.g. duplicates in data for a unique index
+                print('index {0} on {1} not created: {2}'.format(index.document['name'], collection_name, e))
+
+
+def explore_shapes():
+    sorts = [None, 'title', 'likes', 'date_ascending', 'date_descending']
+    filters = [
+        [],
+        [('type_filter', 'soup')],
+        [('type_filter', 'soup'), ('type_filter', 'drink')],
+        [('hashtag_filter', 'simple')],
+        [('type_filter', 'soup'), ('hashtag_filter', 'simple')],
+        [('title_filter', 'glass wat')],
+        [('image_filter', 'on')],
+    ]
+    explore = schema.form('/recipes/explore', 'post')
+    for sort_by, fields, admin in itertools.product(sorts, filters, [False, True]):
+        values, _ = explore(MultiDict(fields + ([('sort_by', sort_by)] if sort_by else [])))
+        sort_opt, filter_opt = RequestValidator.sort_filter_options(values)
+        filter_opt.update({'status': {'$in': ['active', 'locked']} if admin else 'active'})
+        if sort_opt[0][0] == 'score':  # relevance is sorted in memory after matching, only the match matters
+            yield 'explore by relevance {0}{1}'.format(fields, ' admin' if admin else ''), 'recipes', filter_opt, None
+            continue
+        yield 'explore {0} {1}{2}'.format(sort_by, fields, ' admin' if admin else ''), \
+            'recipes', filter_opt, sort_opt
+        last_item = {'likes_total': 3, 'date': 1622505600.0, 'title': 'A glass of water', 'recipe_id': 100000}
+        filter_opt.update(RequestValidator.cursor_filter(RequestValidator.encode_cursor(sort_opt, last_item), sort_opt))
+        yield 'explore {0} {1}{2} after cursor'.format(sort_by, fields, ' admin' if admin else ''), \
+            'recipes', filter_opt, sort_opt
+
+
+def query_shapes():
+    """(description, collection, filter, sort) of every query the handlers issue"""
+    yield 'user by id', 'users', {'user_id': 100000}, None
+    yield 'user by nickname', 'users', {'nickname': 'admin'}, None
+    for sort_by, admin in itertools.product(['recipes_total', 'likes_total'], [False, True]):
+        yield 'leaderboard rebuild by {0}{1}'.format(sort_by, ' admin' if admin else ''), 'users', \
+            {'status': {'$in': ['active', 'locked'] if admin else ['active']}}, [(sort_by, DESC)]
+    yield 'recipe by id', 'recipes', {'recipe_id': 100000}, None
+    yield 'recipe by title', 'recipes', {'title': 'A glass of water'}, None
+    yield 'recipes by image', 'recipes', {'image_id': 'x'}, None
+    yield 'favorites', 'recipes', {'recipe_id': {'$in': [100000, 100001]}, 'status': 'active'}, None
+    for direction in [DESC, ASC]:
+        yield 'favorites page {0}'.format(direction), 'likes', {'user_id': 100000}, \
+            [('date', direction), ('recipe_id', direction)]
+    for sort_by in ['title', 'likes', 'date_ascending', 'date_descending']:
+        sort_opt, filter_opt = RequestValidator.sort_filter_options({'sort_by': sort_by})
+        yield 'recipes of profile by {0}'.format(sort_by), 'recipes', {'author_id': 100000, 'status': 'active'}, \
+            sort_opt
+    yield 'authors by nickname prefix', 'users', {'nickname_tokens': RequestValidator.prefix_match(['jo'])}, None
+    yield 'recent likes for trending', 'likes', {'date': {'$gte': 1622505600.0}}, None
+    yield 'likes of recipe', 'likes', {'recipe_id': 100000}, None
+    yield 'likers page', 'likes', {'recipe_id': 100000, 'user_id': {'$gt': 100000}}, [('user_id', ASC)]
+    yield 'liked set of user', 'likes', {'user_id': 100000}, None
+    yield 'like of user', 'likes', {'user_id': 100000, 'recipe_id': 100000}, None
+    yield 'cascades to resume', 'cascades', {'state': 'running', 'lease_until': {'$lt': 1622505600.0}}, None
+    yield 'explore by author', 'recipes', {'author_id': {'$in': [100000, 100001]}, 'status': 'active'}, None
+    for shape in explore_shapes():
+        yield shape
+
+
+def plan_stages(plan):
+    yield plan.get('stage')
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            for stage in plan_stages(child):
+                yield stage
+
+
+def verify_indexes():
+    failed = 0
+    for description, collection_name, filter_opt, sort_opt in query_shapes():
+        cursor = Database.database()[collection_name].find(filter_opt, limit=10)
+        if sort_opt:
+            cursor = cursor.sort(sort_opt)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        stages = list(plan_stages(plan.get('queryPlan', plan)))
+        collscan = 'COLLSCAN' in stages
+        failed += collscan
+        print('{0:8} {1}: {2}'.format('COLLSCAN' if collscan else 'ok', description, ' <- '.join(stages)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='database indexes')
+    parser.add_argument('command', choices=['apply', 'verify'],
+                        help='apply: create indexes; verify: apply and fail if any handler query plans a COLLSCAN')
+    args = parser.parse_args()
+    apply_indexes()
+    if args.command == 'verify' and verify_indexes():
+        sys.exit(1)
@@ -0,0 +1,181 @@
+# encoding: utf-8
+import os
+import asyncio
+import itertools
+from models import Database
+
+
+class Leaderboard:
+    """Top users by recipes_total and likes_total for /peoples, kept in memory.
+
+    Each view (metric, active users or all) holds the POOL best users with their counters, which follow
+    every increment going through the counter buffer. A user outside the pool had at most the view's
+    floor at the last rebuild, so it is read from mongo and let in only once the increments it got since
+    could lift it into the shown top. Everything else (status changes, deletion cascades, a pool whose
+    members dropped below the floor) is repaired by a full rebuild, also run every REBUILD_INTERVAL seconds"""
+    SIZE = 10
+    POOL = int(os.environ.get('RS_LEADERBOARD_POOL', '200'))
+    REBUILD_INTERVAL = float(os.environ.get('RS_LEADERBOARD_REBUILD', '300'))
+    METRICS = ['recipes_total', 'likes_total']
+    STATUSES = {'active': ['active'], 'all': ['active', 'locked']}
+    VIEWS = list(itertools.product(METRICS, STATUSES))
+    FIELDS = ['user_id', 'nickname', 'status', 'recipes_total', 'likes_total']
+    _users = {}  # user_id -> entry with FIELDS, shared by all views
+    _pools = {view: set() for view in VIEWS}
+    _floors = {view: -1 for view in VIEWS}
+    _outsiders = {view: {} for view in VIEWS}  # user_id -> increments since the last rebuild
+    _task = None
+    _rebuild = None
+    _fetching = set()
+
+    @staticmethod
+    async def start():
+        Database.counter_buffer().listeners.append(Leaderboard.on_increment)
+        await Leaderboard.rebuild()
+        Leaderboard._task = asyncio.ensure_future(Leaderboard._run())
+
+    @staticmethod
+    async def _run():
+        while True:
+            await asyncio.sleep(Leaderboard.REBUILD_INTERVAL)
+            await Leaderboard.rebuild()
+
+    @staticmethod
+    def load(view):
+        metric, statuses = view
+        return list(Database.users_collection().find(
+            {'status': {'$in': Leaderboard.STATUSES[statuses]}}, projection=Leaderboard.FIELDS,
+            sort=[(metric, -1)], limit=Leaderboard.POOL))
+
+    @staticmethod
+    async def rebuild():
+        if not Leaderboard._rebuild:  # one at a time, concurrent callers wait for the running one
+            Leaderboard._rebuild = asyncio.ensure_future(Leaderboard._load_all())
+            Leaderboard._rebuild.add_done_callback(Leaderboard._rebuilt)
+        try:
+            await asyncio.shield(Leaderboard._rebuild)
+        except Exception as e:  # the previous lists are kept
+            print('leaderboard rebuild failed: {0}'.format(e))
+
+    @staticmethod
+    def _rebuilt(task):
+        Leaderboard._rebuild = None
+
+    @staticmethod
+    def schedule_rebuild():
+        if not Leaderboard._rebuild:
+            asyncio.ensure_future(Leaderboard.rebuild())
+
+    @staticmethod
+    async def _load_all():
+        loop = asyncio.get_event_loop()
+        loaded = await asyncio.gather(*[
+            loop.run_in_executor(Database.executor(), Leaderboard.load, view) for view in Leaderboard.VIEWS])
+        users, pools, floors = {}, {}, {}
+        for view, documents in zip(Leaderboard.VIEWS, loaded):
+            for document in documents:
+                users.setdefault(document['user_id'], Leaderboard.entry(document))
+            pools[view] = {document['user_id'] for document in documents}
+            # fewer users than the pool: everyone is in it and any newcomer may enter
+            floors[view] = documents[-1].get(view[0], 0) if len(documents) == Leaderboard.POOL else -1
+        Leaderboard._users, Leaderboard._pools, Leaderboard._floors = users, pools, floors
+        Leaderboard._outsiders = {view: {} for view in Leaderboard.VIEWS}
+
+    @staticmethod
+    def entry(document):
+        entry = {field: document.get(field, 0) for field in Leaderboard.FIELDS}
+        for metric in Leaderboard.METRICS:  # mongo is behind by what the buffer has not written yet
+            entry[metric] += Database.counter_buffer().pending_delta(
+                Database.users_collection(), 'user_id', document['user_id'], metric)
+        return entry
+
+    @staticmethod
+    def threshold(view):
+        """value a user needs to be shown in the view"""
+        values = sorted((Leaderboard._users[user_id][view[0]] for user_id in Leaderboard._pools[view]
+                         if Leaderboard._users[user_id]['status'] in Leaderboard.STATUSES[view[1]]), reverse=True)
+        return values[Leaderboard.SIZE - 1] if len(values) >= Leaderboard.SIZE else -1
+
+    @staticmethod
+    def on_increment(collection_name, user_id, field, delta):
+        if collection_name != 'users' or field not in Leaderboard.METRICS:
+            return
+        if user_id in Leaderboard._users:
+            Leaderboard._users[user_id][field] += delta
+        for view in Leaderboard.VIEWS:
+            if view[0] != field:
+                continue
+            if user_id in Leaderboard._pools[view]:
+                if delta < 0 and Leaderboard.threshold(view) < Leaderboard._floors[view]:
+                    Leaderboard.schedule_rebuild()  # an unknown outsider may be ahead now
+                continue
+            outsiders = Leaderboard._outsiders[view]
+            outsiders[user_id] = outsiders.get(user_id, 0) + delta
+            if Leaderboard._floors[view] + outsiders[user_id] >= Leaderboard.threshold(view):
+                Leaderboard.fetch(user_id)
+
+    @staticmethod
+    def fetch(user_id):
+        if user_id in Leaderboard._fetching:
+            return
+        Leaderboard._fetching.add(user_id)
+        task = asyncio.ensure_future(Leaderboard._fetch(user_id))
+        task.add_done_callback(lambda _: Leaderboard._fetching.discard(user_id))
+
+    @staticmethod
+    async def _fetch(user_id):
+        try:
+            document = await Database.users_async().find_one({'user_id': user_id}, projection=Leaderboard.FIELDS)
+        except Exception as e:
+            print(e)
+            return
+        if document:
+            Leaderboard.admit(document)
+
+    @staticmethod
+    def admit(document):
+        """puts a user read from mongo into the views it can be shown in"""
+        entry = Leaderboard.entry(document)
+        Leaderboard._users[entry['user_id']] = entry
+        for view in Leaderboard.VIEWS:
+            if entry['status'] in Leaderboard.STATUSES[view[1]] and entry[view[0]] > Leaderboard._floors[view]:
+                Leaderboard._pools[view].add(entry['user_id'])
+                Leaderboard._outsiders[view].pop(entry['user_id'], None)
+            elif entry['user_id'] not in Leaderboard._pools[view]:  # exact now, not fetched again for nothing
+                Leaderboard._outsiders[view][entry['user_id']] = entry[view[0]] - Leaderboard._floors[view]
+
+    @staticmethod
+    def update(user_id, **fields):
+        """nickname changed"""
+        if user_id in Leaderboard._users:
+            Leaderboard._users[user_id].update(fields)
+
+    @staticmethod
+    def set_status(user_id, status):
+        Leaderboard.update(user_id, status=status)
+        Leaderboard.schedule_rebuild()  # an unlocked user may belong to the active view
+
+    @staticmethod
+    def remove(user_id):
+        Leaderboard._users.pop(user_id, None)
+        for view in Leaderboard.VIEWS:
+            Leaderboard._pools[view].discard(user_id)
+            Leaderboard._outsiders[view].pop(user_id, None)
+
+    @staticmethod
+    def top(metric, statuses):
+        """the shown list of a view, statuses is 'active' or 'all'"""
+        view = (metric, statuses)
+        entries = [Leaderboard._users[user_id] for user_id in Leaderboard._pools[view]]
+        entries = [entry for entry in entries if entry['status'] in Leaderboard.STATUSES[statuses]]
+        entries.sort(key=lambda entry: (-entry[metric], entry['user_id']))
+        return [dict(entry) for entry in entries[:Leaderboard.SIZE]]
+
+    @staticmethod
+    async def shutdown():
+        if Leaderboard._task:
+            Leaderboard._task.cancel()
+            await asyncio.gather(Leaderboard._task, return_exceptions=True)
+            Leaderboard._task = None
+        if Leaderboard.on_increment in Database.counter_buffer().listeners:
+            Database.counter_buffer().listeners.remove(Leaderboard.on_increment)
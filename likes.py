@@ -0,0 +1,109 @@
+# encoding: utf-8
+import os
+import argparse
+from pymongo.errors import BulkWriteError
+from models import Database
+from cache import TTLCache
+
+# viewers with more likes than this get liked_by_me from a query per page instead of a cached set
+LIKED_SET_LIMIT = int(os.environ.get('RS_LIKED_SET_LIMIT', '2000'))
+
+
+class LikedSets:
+    """recipe ids liked by recent viewers, so liked_by_me of a whole page is a set intersection; read from
+    the (user_id, recipe_id) likes index without touching documents, kept up to date by this process's likes
+    and by other processes' after RS_LIKED_SETS_TTL"""
+    TOO_MANY = False
+    _sets = TTLCache(int(os.environ.get('RS_LIKED_SETS_SIZE', '10000')),
+                     float(os.environ.get('RS_LIKED_SETS_TTL', '30')))
+
+    @staticmethod
+    def load(user_id):
+        likes = Database.likes_collection().find({'user_id': user_id}, projection={'_id': False, 'recipe_id': True},
+                                                 limit=LIKED_SET_LIMIT + 1)
+        liked = {like['recipe_id'] for like in likes}
+        return liked if len(liked) <= LIKED_SET_LIMIT else LikedSets.TOO_MANY
+
+    @staticmethod
+    async def liked(user_id, recipe_ids):
+        """those of recipe_ids liked by user_id"""
+        if not recipe_ids:
+            return set()
+        liked = LikedSets._sets.get(user_id)
+        if liked is None:
+            liked = await Database.run(LikedSets.load, user_id)
+            LikedSets._sets.set(user_id, liked)
+        if liked is LikedSets.TOO_MANY:
+            likes = await Database.likes_async().find_list(
+                {'user_id': user_id, 'recipe_id': {'$in': list(recipe_ids)}},
+                projection={'_id': False, 'recipe_id': True})
+            return {like['recipe_id'] for like in likes}
+        return liked.intersection(recipe_ids)
+
+    @staticmethod
+    async def mark(user_id, documents, batch_size=100):
+        """sets liked_by_me on recipes of an async iterator, looked up batch_size recipes at a time"""
+        batch = []
+        async for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_size:
+                for document in await LikedSets.marked(user_id, batch):
+                    yield document
+                batch = []
+        for document in await LikedSets.marked(user_id, batch):
+            yield document
+
+    @staticmethod
+    async def marked(user_id, recipes):
+        liked = await LikedSets.liked(user_id, [recipe['recipe_id'] for recipe in recipes])
+        for recipe in recipes:
+            recipe['liked_by_me'] = recipe['recipe_id'] in liked
+        return recipes
+
+    @staticmethod
+    def changed(user_id, recipe_id, like):
+        liked = LikedSets._sets.peek(user_id)
+        if liked is None or liked is LikedSets.TOO_MANY:
+            return
+        if like:
+            liked.add(recipe_id)
+            if len(liked) > LIKED_SET_LIMIT:
+                LikedSets._sets.set(user_id, LikedSets.TOO_MANY)
+        else:
+            liked.discard(recipe_id)
+
+    @staticmethod
+    def stats():
+        return LikedSets._sets.stats()
+
+
+def backfill(batch_size):
+    """moves likes arrays of recipes liked before the likes collection into it; counters are left as is"""
+    recipes, likes = Database.recipes_collection(), Database.likes_collection()
+    done = 0
+    while True:
+        batch = list(recipes.find({'likes': {'$exists': True}},
+                                  projection=['recipe_id', 'author_id', 'date', 'likes'], limit=batch_size))
+        if not batch:
+            break
+        documents = [{'user_id': user_id, 'recipe_id': recipe['recipe_id'], 'author_id': recipe.get('author_id'),
+                      'date': recipe.get('date')}
+                     for recipe in batch for user_id in set(recipe.get('likes') or [])]
+        if documents:
+            try:
+                likes.insert_many(documents, ordered=False)
+            except BulkWriteError as e:  # liked again after the collection appeared
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+        recipes.update_many({'recipe_id': {'$in': [recipe['recipe_id'] for recipe in batch]}},
+                            {'$unset': {'likes': ''}})
+        done += len(batch)
+        print('likes of {0} recipes moved'.format(done))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='recipe likes')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    backfill(args.batch_size)
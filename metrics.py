@@ -0,0 +1,190 @@
+# encoding: utf-8
+import os
+import time
+import bisect
+import threading
+import contextvars
+from aiohttp import web
+from pymongo import monitoring
+
+TIMING_HEADER = bool(os.environ.get('RS_TIMING_HEADER'))
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# seconds spent per part of the request being handled; copied into database executor threads by
+# AsyncCollection.run, so the command listener adds to the dict of the request that issued the command
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def add_timing(part, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[part] = timings.get(part, 0.0) + seconds
+
+
+class timed:
+    """with timed('auth'): ... adds the time spent inside to the current request's timings"""
+
+    def __init__(self, part):
+        self.part = part
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *args):
+        add_timing(self.part, time.perf_counter() - self.started)
+
+
+class Counter:
+    def __init__(self, name, description, labels):
+        self.name, self.description, self.labels = name, description, labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def render(self, kind='counter'):
+        yield '# HELP {0} {1}'.format(self.name, self.description)
+        yield '# TYPE {0} {1}'.format(self.name, kind)
+        for labels, value in sorted(self.values.items()):
+            yield '{0}{1} {2}'.format(self.name, format_labels(self.labels, labels), value)
+
+
+class Gauge(Counter):
+    def render(self, kind='gauge'):
+        return super().render(kind)
+
+
+class Histogram:
+    def __init__(self, name, description, labels, buckets=LATENCY_BUCKETS):
+        self.name, self.description, self.labels, self.buckets = name, description, labels, buckets
+        self.series = {}  # labels -> [count per bucket..., count above the last, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self):
+        yield '# HELP {0} {1}'.format(self.name, self.description)
+        yield '# TYPE {0} histogram'.format(self.name)
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ['+Inf'], series[:-1]):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(
+                    self.name, format_labels(self.labels + ('le',), labels + (str(bound),)), cumulative)
+            yield '{0}_sum{1} {2}'.format(self.name, format_labels(self.labels, labels), series[-1])
+            yield '{0}_count{1} {2}'.format(self.name, format_labels(self.labels, labels), cumulative)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+http_requests = Counter('recipes_http_requests_total', 'requests answered', ('route', 'method', 'status'))
+http_latency = Histogram('recipes_http_request_duration_seconds', 'request handling time', ('route', 'method'))
+http_in_flight = Gauge('recipes_http_requests_in_flight', 'requests being handled', ())
+mongo_latency = Histogram('recipes_mongo_command_duration_seconds', 'mongo command round trip time',
+                          ('collection', 'command'))
+mongo_failures = Counter('recipes_mongo_command_failures_total', 'failed mongo commands', ('collection', 'command'))
+mongo_returned = Counter('recipes_mongo_documents_returned_total', 'documents in replies of find, getMore and '
+                         'aggregate', ('collection', 'command'))
+mongo_written = Counter('recipes_mongo_documents_written_total', 'documents inserted, matched by updates or deleted',
+                        ('collection', 'command'))
+REGISTRY = [http_requests, http_latency, http_in_flight, mongo_latency, mongo_failures, mongo_returned, mongo_written]
+
+
+class CommandTimings(monitoring.CommandListener):
+    """times every command sent by the client and counts the documents its reply carries"""
+
+    def __init__(self):
+        self._collections = {}  # request_id -> collection, from started to succeeded or failed
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        self._collections[event.request_id] = collection if isinstance(collection, str) else ''
+
+    def succeeded(self, event):
+        labels = (self._collections.pop(event.request_id, ''), event.command_name)
+        seconds = event.duration_micros / 1e6
+        mongo_latency.observe(labels, seconds)
+        add_timing('db', seconds)
+        reply = event.reply
+        cursor = reply.get('cursor')
+        if isinstance(cursor, dict):
+            mongo_returned.inc(labels, len(cursor.get('firstBatch', cursor.get('nextBatch', []))))
+        elif event.command_name in ['insert', 'update', 'delete'] and reply.get('n'):
+            mongo_written.inc(labels, reply['n'])
+
+    def failed(self, event):
+        labels = (self._collections.pop(event.request_id, ''), event.command_name)
+        mongo_failures.inc(labels)
+        mongo_latency.observe(labels, event.duration_micros / 1e6)
+        add_timing('db', event.duration_micros / 1e6)
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource else 'unmatched'
+    timings = {}
+    token = request_timings.set(timings)
+    http_in_flight.inc((), 1)
+    started = time.perf_counter()
+    status, response = 500, None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        total = time.perf_counter() - started
+        http_in_flight.inc((), -1)
+        http_requests.inc((route, request.method, str(status)))
+        http_latency.observe((route, request.method), total)
+        request_timings.reset(token)
+        if TIMING_HEADER and response is not None and not response.prepared:
+            response.headers['Server-Timing'] = ', '.join(
+                '{0};dur={1:.2f}'.format(part, seconds * 1000) for part, seconds in
+                sorted(timings.items()) + [('total', total)])
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics(request):
+    token = os.environ.get('RS_METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != 'Bearer ' + token:
+        return web.Response(status=401)
+    return web.Response(body=render().encode('utf-8'), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-cache',
+    })
+
+
+async def serve_metrics(port):
+    """serves /metrics alone on a port of the worker's own, so each worker can be scraped; returns the runner
+    to clean up"""
+    app = web.Application()
+    app.add_routes([web.get('/metrics', metrics)])
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
@@ -1,21 +1,36 @@
 # encoding: utf-8
 import re
+import os
+import asyncio
+import functools
+import contextvars
+import itertools
 import pymongo
 import hashlib
-import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from metrics import CommandTimings
 
 
 class DatabaseUpdateException(Exception):
     pass
 
 
+def tokenize(text):
+    """lowercase words of text; title and nickname search match query prefixes against them"""
+    return sorted(set(re.findall(r'\w+', (text or '').lower())))
+
+
 class User:
     _PASSWORD_SALT = 'super secret'
 
     def __init__(self, **kwargs):
-        self.user_id = kwargs.get('user_id', Database.get_free_id(Database.users_collection()))
+        self.user_id = kwargs.get('user_id')
         self.nickname = kwargs.get('nickname')
+        self.nickname_tokens = tokenize(self.nickname)
         self.status = kwargs.get('status', 'active')
         self.favorites = kwargs.get('favorites', [])
         self.likes_total = kwargs.get('likes_total', 0)
@@ -27,40 +42,78 @@ class User:
         self.isAdmin = False
         self.validate()
 
-    def add_recipe(self, recipe_id):
+    async def save(self):
+        if self.user_id is None:
+            self.user_id = await Database.get_free_id_async(Database.users_collection(), 'user_id')
+        await Database.users_async().insert_one(self.__dict__)
+
+    async def add_recipe(self, recipe_id):
+        await self.add_recipes([recipe_id])
+
+    async def add_recipes(self, recipe_ids):
         try:
-            Database.users_collection().update_one({'user_id': self.user_id}, [
-                {'$set': {'recipes': {'$concatArrays': ['$recipes', [recipe_id]]}}}
+            await Database.users_async().update_one({'user_id': self.user_id}, [
+                {'$set': {'recipes': {'$concatArrays': ['$recipes', recipe_ids]}}}
             ])
-            self.recipes.append(recipe_id)
-            Database.users_collection().update_one({'user_id': self.user_id}, {
-                '$inc': {'recipes_total': 1}
-            })
-            self.recipes_total += 1
+            self.recipes.extend(recipe_ids)
+            Database.counter_buffer().add(
+                Database.users_collection(), 'user_id', self.user_id, 'recipes_total', len(recipe_ids))
+            self.recipes_total += len(recipe_ids)
         except Exception as e:
             print(e)
             raise DatabaseUpdateException
 
-    def like_recipe(self, recipe):
+    async def like_recipe(self, recipe):
+        """returns False if the recipe was liked already"""
         try:
-            Database.users_collection().update_one({'user_id': self.user_id}, [
-                {'$set': {'favorites': {'$concatArrays': ['$favorites', [recipe.recipe_id]]}}}
-            ])
-            self.favorites.append(recipe.recipe_id)
-            Database.recipes_collection().update_one({'recipe_id': recipe.recipe_id}, [
-                {'$set': {'likes': {'$concatArrays': ['$likes', [self.user_id]]}}}
-            ])
-            recipe.likes.append(self.user_id)
-            Database.recipes_collection().update_one({'recipe_id': recipe.recipe_id}, {
-                '$inc': {'likes_total': 1}
-            })
-            recipe.likes_total += 1
-            Database.users_collection().update_one({'user_id': recipe.author_id}, {
-                '$inc': {'likes_total': 1}
+            # unique (user_id, recipe_id) makes a second like of the same recipe a no-op
+            await Database.likes_async().insert_one({
+                'user_id': self.user_id, 'recipe_id': recipe.recipe_id, 'author_id': recipe.author_id,
+                'date': time.time()})
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            print(e)
+            raise DatabaseUpdateException
+        try:
+            await self._count_like(recipe, 1)
+        except DatabaseUpdateException:
+            await Database.likes_async().delete_one({'user_id': self.user_id, 'recipe_id': recipe.recipe_id})
+            raise
+        self.favorites.append(recipe.recipe_id)
+        return True
+
+    async def unlike_recipe(self, recipe):
+        """returns the removed like, None if the recipe was not liked"""
+        try:
+            like = await Database.likes_async().find_one_and_delete(
+                {'user_id': self.user_id, 'recipe_id': recipe.recipe_id}, projection={'_id': False})
+        except Exception as e:
+            print(e)
+            raise DatabaseUpdateException
+        if not like:
+            return None
+        try:
+            await self._count_like(recipe, -1)
+        except DatabaseUpdateException:
+            await Database.likes_async().insert_one(dict(like))
+            raise
+        if recipe.recipe_id in self.favorites:
+            self.favorites.remove(recipe.recipe_id)
+        return like
+
+    async def _count_like(self, recipe, delta):
+        try:
+            await Database.users_async().update_one({'user_id': self.user_id}, {
+                '$addToSet' if delta > 0 else '$pull': {'favorites': recipe.recipe_id}
             })
         except Exception as e:
             print(e)
             raise DatabaseUpdateException
+        # hot documents of a popular recipe and its author: merged with other likes, written behind
+        Database.counter_buffer().add(Database.recipes_collection(), 'recipe_id', recipe.recipe_id, 'likes_total', delta)
+        Database.counter_buffer().add(Database.users_collection(), 'user_id', recipe.author_id, 'likes_total', delta)
+        recipe.likes_total += delta
 
     @staticmethod
     def encrypt_password(password):
@@ -68,7 +121,7 @@ class User:
 
     def validate(self):
         assert all([
-            type(self.user_id) == int,
+            self.user_id is None or type(self.user_id) == int,
             re.match(r'^[\w\d]+[\w\d ]*[\w\d]+$', self.nickname),
             self.status in ['active', 'locked'],
             (type(self.favorites) == list and
@@ -81,71 +134,346 @@ class User:
 
 class Recipe:
     def __init__(self, **kwargs):
-        self.recipe_id = kwargs.get('recipe_id', Database.get_free_id(Database.recipes_collection()))
+        self.recipe_id = kwargs.get('recipe_id')
         self.author_id = kwargs.get('author_id')
         self.author = kwargs.get('author')
         self.date = kwargs.get('date', time.time())
         self.title = kwargs.get('title', '')
+        self.title_tokens = tokenize(self.title)
         self.type = kwargs.get('type', 'other')
         self.description = kwargs.get('description', '')
         self.steps = kwargs.get('steps', [])
         self.status = kwargs.get('status', 'active')
         self.hashtags = kwargs.get('hashtags', [])
-        self.likes = kwargs.get('likes', [])
         self.likes_total = kwargs.get('likes_total', 0)
-        self.image_bytes = kwargs.get('image_bytes', None)
+        self.image_id = kwargs.get('image_id', None)
+        self.thumbnails = kwargs.get('thumbnails', [])
         self.validate()
 
-    def delete_recipe(self, user):
+    async def save(self):
+        if self.recipe_id is None:
+            self.recipe_id = await Database.get_free_id_async(Database.recipes_collection(), 'recipe_id')
+        await Database.recipes_async().insert_one(self.__dict__)
+
+    async def delete_recipe(self, user):
+        """removes the recipe and its author's stats; likes and favorites of likers are left to cascade.Cascade"""
         try:
-            Database.users_collection().update_one(
+            deleted = await Database.recipes_async().find_one_and_delete(
+                {'recipe_id': self.recipe_id}, projection={'_id': False, 'likes_total': True})
+            if not deleted:  # deleted concurrently, its counters are the other request's
+                return
+            await Database.users_async().update_one(
                 {'user_id': self.author_id}, {'$pull': {'recipes': self.recipe_id}})
-            user.recipes.remove(self.recipe_id)
-            Database.users_collection().update_one(
-                {'user_id': self.author_id}, {'$inc': {'likes_total': -self.likes_total}}
-            )
-            for user_id in self.likes:
-                Database.users_collection().update_one(
-                    {'user_id': user_id}, {'$pull': {'favorites': self.recipe_id}})
-            Database.recipes_collection().delete_one({'recipe_id': self.recipe_id})
+            if self.recipe_id in user.recipes:
+                user.recipes.remove(self.recipe_id)
+            buffer = Database.counter_buffer()
+            buffer.add(Database.users_collection(), 'user_id', self.author_id, 'recipes_total', -1)
+            # likes written at deletion plus likes still buffered, which now update no document
+            likes_total = deleted.get('likes_total', 0) + buffer.pending_delta(
+                Database.recipes_collection(), 'recipe_id', self.recipe_id, 'likes_total')
+            if likes_total:
+                buffer.add(Database.users_collection(), 'user_id', self.author_id, 'likes_total', -likes_total)
         except Exception as e:
             print(e)
             raise DatabaseUpdateException
 
     def validate(self):
         assert all([
+            self.recipe_id is None or type(self.recipe_id) is int,
             type(self.author_id) is int,
             re.match(r'^[\w\d]+[\w\d ]*[\w\d]+$', self.title),
             self.type in ['other', 'drink', 'salad', 'first course', 'second course', 'soup', 'dessert']
         ])
 
 
+class IdAllocator:
+    """Hands out ids from blocks reserved in the counters collection; one $inc per block,
+    so inserts never scan the collection and several processes never get the same id"""
+    BLOCK_SIZE = int(os.environ.get('RS_ID_BLOCK_SIZE', '100'))
+    FIRST_ID = 100000
+
+    def __init__(self, collection, id_field):
+        self.collection = collection
+        self.id_field = id_field
+        self._lock = threading.Lock()
+        self._seeded = False
+        self._next = 0
+        self._end = 0
+
+    def allocate(self):
+        with self._lock:
+            if self._next >= self._end:
+                self._reserve_block()
+            free_id = self._next
+            self._next += 1
+            return free_id
+
+    def _seed(self):
+        # start after ids already given out (old random ids included), idempotent across processes
+        last = self.collection.find_one(
+            {self.id_field: {'$type': 'number'}}, projection=[self.id_field], sort=[(self.id_field, -1)])
+        first_id = max(IdAllocator.FIRST_ID, last[self.id_field] + 1 if last else 0)
+        try:
+            Database.counters_collection().update_one(
+                {'_id': self.collection.name}, {'$max': {'next': first_id}}, upsert=True)
+        except DuplicateKeyError:  # another process created the counter in the meantime
+            Database.counters_collection().update_one(
+                {'_id': self.collection.name}, {'$max': {'next': first_id}})
+        self._seeded = True
+
+    def _reserve_block(self):
+        if not self._seeded:
+            self._seed()
+        counter = Database.counters_collection().find_one_and_update(
+            {'_id': self.collection.name}, {'$inc': {'next': IdAllocator.BLOCK_SIZE}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        self._end = counter['next']
+        self._next = self._end - IdAllocator.BLOCK_SIZE
+
+
+class CounterBuffer:
+    """Write-behind $inc of hot counters: increments are merged per document and written with one
+    unordered bulk_write per collection every interval seconds, or sooner once size documents are pending"""
+
+    def __init__(self, interval, size):
+        self.interval = interval
+        self.size = size
+        self.last_flush_duration = 0.0
+        self.flushes = 0
+        self._pending = {}  # (collection name, id field, id) -> {counter field: delta}
+        self._oldest = None
+        self._wakeup = None
+        self._task = None
+        self._closing = False
+        self._late_flushes = set()  # of increments added once close() has begun
+        self.listeners = []  # called with (collection name, id, field, delta) on every increment
+
+    def add(self, collection, id_field, document_id, field, delta):
+        counters = self._pending.setdefault((collection.name, id_field, document_id), {})
+        counters[field] = counters.get(field, 0) + delta
+        for listener in self.listeners:
+            listener(collection.name, document_id, field, delta)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self._closing:  # no loop to write it any more, e.g. a request finishing during shutdown
+            flush = asyncio.ensure_future(self.flush())
+            self._late_flushes.add(flush)
+            flush.add_done_callback(self._late_flushes.discard)
+            return
+        if not self._task:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        if len(self._pending) >= self.size:
+            self._wakeup.set()
+
+    def pending(self):
+        return len(self._pending)
+
+    def pending_delta(self, collection, id_field, document_id, field):
+        """increment of the field not written yet, to add to a value just read from mongo"""
+        return self._pending.get((collection.name, id_field, document_id), {}).get(field, 0)
+
+    def lag(self):
+        """seconds the oldest unwritten increment is waiting, i.e. how stale counters read from mongo can be"""
+        return time.monotonic() - self._oldest if self._oldest is not None else 0.0
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, oldest = self._pending, self._oldest
+        self._pending, self._oldest = {}, None
+        started = time.monotonic()
+        loop = asyncio.get_event_loop()
+        failed = await loop.run_in_executor(Database.executor(), CounterBuffer._write, pending)
+        for key, counters in failed.items():  # retried with the next flush
+            merged = self._pending.setdefault(key, {})
+            for field, delta in counters.items():
+                merged[field] = merged.get(field, 0) + delta
+        if failed:
+            self._oldest = min(oldest, self._oldest or oldest)
+        self.last_flush_duration = time.monotonic() - started
+        self.flushes += 1
+
+    @staticmethod
+    def _write(pending):
+        """returns increments that were not applied"""
+        by_collection = {}
+        for key, counters in pending.items():
+            by_collection.setdefault(key[0], []).append(key)
+        failed = {}
+        for collection_name, keys in by_collection.items():
+            try:
+                Database.database()[collection_name].bulk_write(
+                    [UpdateOne({key[1]: key[2]}, {'$inc': pending[key]}) for key in keys], ordered=False)
+            except BulkWriteError as e:
+                print(e)
+                failed.update({keys[error['index']]: pending[keys[error['index']]]
+                               for error in e.details['writeErrors']})
+            except Exception as e:  # nothing known to be written
+                print(e)
+                failed.update({key: pending[key] for key in keys})
+        return failed
+
+    async def close(self):
+        """drains all pending increments, for shutdown; increments added from now on are written at once"""
+        self._closing = True
+        if self._task:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        while self._late_flushes:
+            await asyncio.gather(*self._late_flushes)
+
+
+class AsyncCollection:
+    """Runs blocking pymongo collection calls on the database executor, so handlers can await them
+    without stalling the event loop"""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def run(self, function, *args, **kwargs):
+        return await Database.run(function, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return functools.partial(self.run, getattr(self.collection, name))
+
+    async def find_list(self, *args, **kwargs):
+        return await self.run(lambda: list(self.collection.find(*args, **kwargs)))
+
+    async def aggregate_list(self, pipeline, **kwargs):
+        return await self.run(lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+
+    async def iterate(self, method, *args, batch_size=100, **kwargs):
+        """yields documents of a find or aggregate cursor, fetching batch_size at a time on the executor"""
+        kwargs['batchSize' if method == 'aggregate' else 'batch_size'] = batch_size
+        cursor = await self.run(getattr(self.collection, method), *args, **kwargs)
+        try:
+            while True:
+                batch = await self.run(lambda: list(itertools.islice(cursor, batch_size)))
+                if not batch:
+                    break
+                for document in batch:
+                    yield document
+        finally:
+            await self.run(cursor.close)
+
+
 class Database:
+    MONGO_URI = os.environ.get('RS_MONGO_URI')  # None is mongod on localhost
+    MONGO_DATABASE = os.environ.get('RS_MONGO_DATABASE', 'database')
     _client = None
     _users = None
     _recipes = None
+    _executor = None
+    _users_async = None
+    _recipes_async = None
+    _counters = None
+    _likes = None
+    _likes_async = None
+    _counter_buffer = None
+    _id_allocators = {}
 
     @staticmethod
     def client():
         if not Database._client:
-            Database._client = pymongo.MongoClient()
+            Database._client = pymongo.MongoClient(Database.MONGO_URI, event_listeners=[CommandTimings()])
         return Database._client
 
+    @staticmethod
+    def database():
+        return Database.client()[Database.MONGO_DATABASE]
+
+    @staticmethod
+    async def run(function, *args, **kwargs):
+        """calls function on the executor in a copy of the caller's context, so commands it sends are
+        timed for the request that awaits them"""
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            Database.executor(), functools.partial(context.run, function, *args, **kwargs))
+
     @staticmethod
     def users_collection():
         if not Database._users:
-            Database._users = Database.client().database.users
+            Database._users = Database.database().users
         return Database._users
 
     @staticmethod
     def recipes_collection():
         if not Database._recipes:
-            Database._recipes = Database.client().database.recipes
+            Database._recipes = Database.database().recipes
         return Database._recipes
 
     @staticmethod
-    def get_free_id(collection):
-        while True:
-            free_id = random.randrange(100000, 1000000)
-            if collection.find().where('this.user_id == {0} || this.recipe_id == {0}'.format(free_id)).count() == 0:
-                return free_id
+    def likes_collection():
+        if not Database._likes:
+            Database._likes = Database.database().likes
+        return Database._likes
+
+    @staticmethod
+    def likes_async():
+        if not Database._likes_async:
+            Database._likes_async = AsyncCollection(Database.likes_collection())
+        return Database._likes_async
+
+    @staticmethod
+    def counters_collection():
+        if not Database._counters:
+            Database._counters = Database.database().counters
+        return Database._counters
+
+    @staticmethod
+    def executor():
+        if not Database._executor:
+            Database._executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('RS_DB_THREADS', '32')), thread_name_prefix='database')
+        return Database._executor
+
+    @staticmethod
+    def users_async():
+        if not Database._users_async:
+            Database._users_async = AsyncCollection(Database.users_collection())
+        return Database._users_async
+
+    @staticmethod
+    def recipes_async():
+        if not Database._recipes_async:
+            Database._recipes_async = AsyncCollection(Database.recipes_collection())
+        return Database._recipes_async
+
+    @staticmethod
+    def counter_buffer():
+        if not Database._counter_buffer:
+            Database._counter_buffer = CounterBuffer(float(os.environ.get('RS_COUNTER_FLUSH_INTERVAL', '0.5')),
+                                                     int(os.environ.get('RS_COUNTER_FLUSH_SIZE', '1000')))
+        return Database._counter_buffer
+
+    @staticmethod
+    def shutdown():
+        if Database._executor:
+            Database._executor.shutdown(wait=True)
+            Database._executor = None
+        if Database._client:
+            Database._client.close()
+
+    @staticmethod
+    def get_free_id(collection, id_field):
+        allocator = Database._id_allocators.get(collection.name)
+        if not allocator:
+            allocator = Database._id_allocators.setdefault(collection.name, IdAllocator(collection, id_field))
+        return allocator.allocate()
+
+    @staticmethod
+    async def get_free_id_async(collection, id_field):
+        return await Database.run(Database.get_free_id, collection, id_field)
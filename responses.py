@@ -0,0 +1,70 @@
+# encoding: utf-8
+import os
+import json
+from aiohttp import web
+from metrics import timed
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used without it
+    orjson = None
+
+ENCODER = os.environ.get('RS_JSON_ENCODER', 'orjson' if orjson else 'json')
+STREAM_CHUNK_SIZE = 64 * 1024
+# collection responses with more items than this are streamed instead of built in memory
+STREAM_PAGE_SIZE = int(os.environ.get('RS_STREAM_PAGE_SIZE', '100'))
+
+
+def dumps(data):
+    """compact json of data as utf-8 bytes"""
+    with timed('serialize'):
+        if ENCODER == 'orjson':
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(data, status=200, headers=None):
+    return web.Response(body=dumps(data), status=status, headers=headers, content_type='application/json')
+
+
+async def stream_collection(request, head, documents, tail=None, status=200):
+    """writes {**head, 'collection': [...], **tail()} while documents, an async iterator, is consumed, so
+    memory does not grow with the collection; tail is called once the collection is written. The status
+    is sent before the first document, a failure while iterating aborts the response"""
+    response = web.StreamResponse(status=status)
+    response.content_type = 'application/json'
+    await response.prepare(request)
+    chunk = bytearray(dumps(head)[:-1])
+    chunk += b',"collection":[' if head else b'"collection":['
+    first = True
+    async for document in documents:
+        if not first:
+            chunk += b','
+        chunk += dumps(document)
+        first = False
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            await response.write(bytes(chunk))
+            chunk.clear()
+    chunk += b']'
+    tail_data = tail() if tail else None
+    if tail_data:
+        chunk += b',' + dumps(tail_data)[1:]
+    else:
+        chunk += b'}'
+    await response.write(bytes(chunk))
+    await response.write_eof()
+    return response
+
+
+def page_parts(head, items):
+    """{**head, 'collection': items} serialized in pieces: head, each item and the end, so fields that differ
+    per viewer can be added to the items of a cached page without serializing it again"""
+    prefix = dumps(head)[:-1] + (b',"collection":[' if head else b'"collection":[')
+    return prefix, [dumps(item) for item in items], b']}'
+
+
+def join_page(parts, item_fields):
+    """body of page_parts with item_fields, one dict per item, merged into the items"""
+    prefix, items, suffix = parts
+    return prefix + b','.join(item[:-1] + b',' + dumps(fields)[1:] for item, fields in zip(items, item_fields)) + \
+        suffix
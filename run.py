@@ -1,21 +1,42 @@
 # encoding: utf-8
 from aiohttp import web
-import json
 import os
-from models import User, Recipe, Database, DatabaseUpdateException
+from models import User, Recipe, Database, DatabaseUpdateException, tokenize
 from validator import RequestValidator
+import schema
+from images import ImageStore, RangeNotSatisfiable
+from thumbnails import Thumbnails
+from indexes import apply_indexes
+from cache import recipes_count_cache, users_auth_cache, explore_cache, EXPLORE_LIKES_TTL, filter_key, recipes_changed
+from bson.son import SON
+from search import Search
+from cascade import Cascade
+from leaderboard import Leaderboard
+from likes import LikedSets
+from facets import Facets
+from responses import json_response, stream_collection, page_parts, join_page, STREAM_PAGE_SIZE
+from uploads import read_form, close_form, UploadTooLarge, EncodedUpload
+from metrics import metrics, metrics_middleware, timed, serve_metrics
+from sessions import session_storage, load_keys
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from multidict import MultiDict
+import pymongo
+import io
+import time
+import signal
+import asyncio
+import hashlib
+import multiprocessing
+import multiprocessing.connection
 
-import base64
 from cryptography import fernet
 import aiohttp_session
-from aiohttp_session.cookie_storage import EncryptedCookieStorage
 
 
 def admin_only(handler):
     async def new_handler(*args, **kwargs):
-        session = await aiohttp_session.get_session(args[0])
-        if not Database.users_collection().find_one({'user_id': session['user_id']}).get('isAdmin'):
-            return web.json_response({
+        if not args[2].get('isAdmin'):  # user found by protect
+            return json_response({
                 'name': 'Forbidden',
                 'message': 'insufficient rights to the resource'
             }, status=403)
@@ -26,10 +47,10 @@ def admin_only(handler):
 def process_recipe_in_uri(handler):
     async def new_handler(*args, **kwargs):
         recipe_id = int(args[0].match_info.get('recipe_id'))
-        recipe = Database.recipes_collection().find_one({'recipe_id': recipe_id})
+        recipe = await Database.recipes_async().find_one({'recipe_id': recipe_id})
         admin = args[2].get('isAdmin')
-        if not recipe or (not admin and recipe.get('status') is 'locked'):
-            return web.json_response({
+        if not recipe or recipe.get('status') == 'deleted' or (not admin and recipe.get('status') == 'locked'):
+            return json_response({
                 'name': 'Not found',
                 'message': 'recipe not found'
             }, status=404)
@@ -37,12 +58,23 @@ def process_recipe_in_uri(handler):
     return new_handler
 
 
+def process_user_in_uri(handler):
+    async def new_handler(*args, **kwargs):
+        user = await Database.users_async().find_one({'user_id': int(args[0].match_info.get('user_id'))},
+                                                     projection=dict.fromkeys(PROFILE_FIELDS, True))
+        unavailable = profile_unavailable(user, args[2])
+        if unavailable:
+            return unavailable
+        return await handler(*args, user, **kwargs)
+    return new_handler
+
+
 def protect_for_user(handler):
     async def new_handler(*args, **kwargs):
         session = await aiohttp_session.get_session(args[0])
         user_id = int(args[0].match_info.get('user_id'))
         if user_id != int(session['user_id']):
-            return web.json_response({
+            return json_response({
                 'name': 'Forbidden',
                 'message': 'insufficient rights to the resource'
             }, status=403)
@@ -52,15 +84,16 @@ def protect_for_user(handler):
 
 def protect(handler):
     async def new_handler(*args, **kwargs):
-        session = await aiohttp_session.get_session(args[0])
-        if 'user_id' not in session:
-            return web.json_response({
+        with timed('auth'):
+            session = await aiohttp_session.get_session(args[0])
+            user = await authenticated_user(int(session['user_id'])) if 'user_id' in session else None
+        if not user:  # no session, or deleted while session alive
+            return json_response({
                 'name': 'Unauthorized',
                 'message': 'your request was made with invalid credentials'
             }, status=401)
-        user = Database.users_collection().find_one({'user_id': int(session['user_id'])})
         if user.get('status') == 'locked':
-            return web.json_response({
+            return json_response({
                 'name': 'Forbidden',
                 'message': 'your account has been locked'
             }, status=403)
@@ -68,66 +101,97 @@ def protect(handler):
     return new_handler
 
 
+async def authenticated_user(user_id):
+    user = users_auth_cache.get(user_id)
+    if user is None:
+        user = await Database.users_async().find_one(
+            {'user_id': user_id}, projection={'_id': False, 'user_id': True, 'nickname': True, 'status': True,
+                                              'isAdmin': True})
+        if user:
+            users_auth_cache.set(user_id, user)
+    return user
+
+
 @protect
 @protect_for_user
 async def delete_user(request, session, user):
     user_id = int(request.match_info.get('user_id'))
-    deleted = Database.users_collection().delete_one({'user_id': user_id})
+    deleted = await Database.users_async().delete_one({'user_id': user_id})
+    users_auth_cache.invalidate(user_id)
     if deleted.deleted_count > 0:
         session.invalidate()
-        return web.json_response({
+        Leaderboard.remove(user_id)
+        # hidden at once, removed with their likes by the cascade job
+        await Database.recipes_async().update_many({'author_id': user_id}, {'$set': {'status': 'deleted'}})
+        recipes_changed()
+        Facets.schedule_reconcile()
+        await Cascade.submit('user', user_id)
+        return json_response({
             'name': 'Deleted',
             'message': 'User {0} deleted successfully'
         }, status=205)
     else:
-        return web.json_response({
+        return json_response({
             'name': 'Not exists',
             'message': 'User {0} is not exists'
         }, status=200)
 
 
+def user_exists(nickname):
+    return json_response({
+        'name': 'OK',
+        'message': 'User {0} already exists'.format(nickname)
+    }, status=200)
+
+
+def recipe_exists(title):
+    return json_response({
+        'name': 'OK',
+        'message': 'recipe {0} already exists'.format(title),
+    }, status=200)
+
+
 async def sign_in(request):
-    data = await request.post()
-    nickname, errors = RequestValidator.validate_single_string('nickname', data, [])
-    password, errors = RequestValidator.validate_single_string('password', data, errors)
-    user = Database.users_collection().find_one({'nickname': nickname})
+    values, errors = schema.form('/signin', 'put')(await request.post())
     if errors:
         return RequestValidator.error_response(errors)
+    nickname, password = values['nickname'], values['password']
+    user = await Database.users_async().find_one({'nickname': nickname})
     if user:
-        return web.json_response({
-            'name': 'OK',
-            'message': 'User {0} already exists'.format(nickname)
-        }, status=200)
+        return user_exists(nickname)
     try:
         user = User(nickname=nickname, password=password)
     except AssertionError:
-        return web.json_response({
+        return json_response({
             'name': 'User validation failed',
             'message': 'nickname does not match syntax, nickname must consist of latin letters, digits and spaces'
         }, status=400)
-    Database.users_collection().insert_one(user.__dict__)
-    return web.json_response({
+    try:
+        await user.save()
+    except DuplicateKeyError:  # signed in concurrently, the unique nickname index lets one through
+        return user_exists(nickname)
+    Leaderboard.admit(user.__dict__)
+    return json_response({
         'name': 'Created',
         'message': 'User {0} created successfully'.format(nickname)
     }, status=201)
 
 
 async def session_generate(request):
-    data = await request.post()
-    nickname, errors = RequestValidator.validate_single_string('nickname', data, [])
-    password, errors = RequestValidator.validate_single_string('password', data, errors)
+    values, errors = schema.form('/auth', 'post')(await request.post())
     if errors:
         return RequestValidator.error_response(errors)
+    nickname, password = values['nickname'], values['password']
     crypt_password = User.encrypt_password(password)
-    user_with_nickname = Database.users_collection().find_one({'nickname': nickname})
+    user_with_nickname = await Database.users_async().find_one({'nickname': nickname})
     if (not user_with_nickname) or user_with_nickname['crypt_password'] != crypt_password:
-        return web.json_response({
+        return json_response({
             'name': 'Bad Request',
             'message': 'incorrect user or password'
         }, status=400)
     session = await aiohttp_session.new_session(request)
     session['user_id'] = user_with_nickname['user_id']
-    return web.json_response({
+    return json_response({
         'name': 'OK',
         'message': 'authorized successfully'
     }, status=200)
@@ -136,118 +200,245 @@ async def session_generate(request):
 @protect
 async def logout(request, session, user):
     session.invalidate()
-    return web.json_response({
+    return json_response({
         'name': 'OK',
         'message': 'logged out'
     }, status=204)
 
 
-@protect
-async def user_profile(request, session, current_user):
-    user_id = int(request.match_info.get('user_id'))
-    user = Database.users_collection().find_one({'user_id': user_id})
+PROFILE_FIELDS = ['user_id', 'nickname', 'status', 'recipes_total', 'likes_total']
+
+
+def profile_unavailable(user, current_user):
     if not user:
-        return web.json_response({
+        return json_response({
             'name': 'Not found',
             'message': 'profile you are looking for appears not to be exist'
         }, status=404)
     if user.get('status') == 'locked' and not current_user.get('isAdmin'):
-        return web.json_response({
+        return json_response({
             'name': 'Locked',
             'message': 'user locked'
         }, status=423)
+    return None
+
+
+@protect
+async def user_profile(request, session, current_user):
+    # counts only; favorites and recipes arrays stay in mongo, their pages are sub-resources
+    users = await Database.users_async().aggregate_list([
+        {'$match': {'user_id': int(request.match_info.get('user_id'))}},
+        {'$project': dict(dict.fromkeys(PROFILE_FIELDS, True), _id=False,
+                          favorites_total={'$size': {'$ifNull': ['$favorites', []]}})},
+    ])
+    user = users[0] if users else None
+    unavailable = profile_unavailable(user, current_user)
+    if unavailable:
+        return unavailable
     response = {
         'name': 'OK',
         'message': 'user profile info',
     }
-    response.update(dict(filter(lambda item: item[0] in [
-        'user_id', 'nickname', 'status', 'recipes_total', 'likes_total'] + (['favorites', 'recipes']
-        if current_user.get('user_id') == user_id or current_user.get('isAdmin') else []), user.items())))
-    return web.json_response(response, status=200)
+    response.update(user)
+    return json_response(response, status=200)
 
 
 @protect
 async def explore_peoples(request, session, user):
-    data = await request.post()
-    sort_by = data.get('sort_by')
-    if type(sort_by) in [bytes, bytearray]:
-        sort_by = sort_by.decode('utf-8')
-    if sort_by not in ['recipes_total', 'likes_total']:
-        sort_by = 'recipes_total'
-    peoples = [user for user in Database.users_collection().find(
-        limit=10, projection=['user_id', 'nickname', 'status', 'recipes_total', 'likes_total'],
-        filter={'status': 'active'} if not user.get('isAdmin') else {}, sort=[(sort_by, -1)])]
-    peoples_reduced = list(map(lambda item: dict(filter(lambda item: item[0] in [
-        'user_id', 'nickname', 'status', 'recipes_total', 'likes_total'], item.items())), peoples))
+    values, errors = schema.form('/peoples', 'post')(await request.post())
+    if errors:
+        return RequestValidator.error_response(errors)
+    sort_by = values.get('sort_by', 'recipes_total')
     response = {
         'name': 'OK',
         'message': 'list of famous ramsy',
-        'collection': peoples_reduced
+        'collection': Leaderboard.top(sort_by, 'all' if user.get('isAdmin') else 'active')
     }
-    return web.json_response(response, status=200)
+    return json_response(response, status=200)
 
 
 @protect
 async def recipe_create(request, session, user):
-    data = await request.post()
-    recipe_title, errors = RequestValidator.validate_single_string('recipe_title', data, [])
-    if errors:
-        return RequestValidator.error_response(errors)
-    if Database.recipes_collection().find_one({'title': recipe_title}):
-        return web.json_response({
-            'name': 'OK',
-            'message': 'recipe {0} already exists'.format(recipe_title),
-        }, status=200)
+    try:
+        data = await read_form(request)
+    except UploadTooLarge as e:
+        return upload_too_large(e)
+    except EncodedUpload as e:
+        return encoded_upload(e)
+    try:
+        return await create_recipe(data, user)
+    finally:
+        close_form(data)
+
+
+async def create_recipe(data, user):
     user = User(**user)
     recipe_options, errors = RequestValidator.recipe_options(data, user)
     if errors:
         return RequestValidator.error_response(errors)
+    recipe_title = recipe_options['title']
+    if await Database.recipes_async().find_one({'title': recipe_title}):
+        return recipe_exists(recipe_title)
     try:
-        recipe = Recipe(**recipe_options)
+        Recipe(**recipe_options)  # validated before the image is stored, so a rejected recipe leaves none behind
     except AssertionError:
-        return web.json_response({
+        return json_response({
             'name': 'Recipe validation failed',
             'message': 'maybe title does not match syntax; title must consist of latin letters, digit and spaces'
         }, status=422)
+    image_id = await store_recipe_image(recipe_options)
+    recipe = Recipe(**recipe_options)
+    try:
+        await recipe.save()
+    except DuplicateKeyError:  # created concurrently, the unique title index lets one through
+        if image_id:
+            await ImageStore.release_async(image_id)
+        return recipe_exists(recipe_title)
     try:
-        Database.recipes_collection().insert_one(recipe.__dict__)
-        user.add_recipe(recipe.recipe_id)
+        await user.add_recipe(recipe.recipe_id)
     except DatabaseUpdateException as e:
-        Database.recipes_collection().delete_one({'recipe_id': recipe.recipe_id})
-        return web.json_response({
+        await Database.recipes_async().delete_one({'recipe_id': recipe.recipe_id})
+        if image_id:
+            await ImageStore.release_async(image_id)
+        return json_response({
             'name': 'Something went wrong',
             'message': 'error when adding recipe to db and rewriting user stats: run.py -> recipe_create'
         }, status=500)
-    return web.json_response({
+    recipes_changed()
+    Facets.added(recipe.__dict__)
+    if image_id:
+        Thumbnails.schedule(image_id)
+    return json_response({
         'name': 'Created',
         'message': 'new recipe {0} successfully created by user {1}'.format(recipe_title, user.nickname)
     }, status=201)
 
 
+BATCH_MAX_RECIPES = int(os.environ.get('RS_BATCH_MAX_RECIPES', '100'))
+
+
+def batch_item_form(item):
+    """recipe of a create-batch body as the form fields recipe_create reads"""
+    return MultiDict((key, str(value)) for key, values in item.items()
+                     for value in (values if isinstance(values, list) else [values]) if value is not None)
+
+
+@protect
+async def recipe_create_batch(request, session, user):
+    try:
+        items = (await request.json()).get('recipes')
+        assert isinstance(items, list) and all(isinstance(item, dict) for item in items)
+    except (ValueError, AttributeError, AssertionError):
+        return json_response({
+            'name': 'Bad request',
+            'message': 'body must be json {"recipes": [{"recipe_title": ..., ...}, ...]}'
+        }, status=400)
+    if not items or len(items) > BATCH_MAX_RECIPES:
+        return RequestValidator.error_response([{
+            'field': 'recipes',
+            'message': 'send 1 to {0} recipes'.format(BATCH_MAX_RECIPES)
+        }])
+    user = User(**user)
+    results, recipes, titles = [], {}, set()  # result per item; index -> Recipe to insert
+    for index, item in enumerate(items):
+        recipe_options, errors = RequestValidator.recipe_options(batch_item_form(item), user)
+        result = {'index': index, 'title': recipe_options.get('title') if recipe_options else item.get('recipe_title')}
+        results.append(result)
+        if errors:
+            result.update(status=422, errors=errors)
+            continue
+        recipe_options.pop('image', None)  # json has no files, images are added with update
+        try:
+            recipe = Recipe(**recipe_options)
+        except AssertionError:
+            result.update(status=422, message='title must consist of latin letters, digit and spaces')
+            continue
+        if recipe.title in titles:
+            result.update(status=422, message='same title as an earlier recipe of the batch')
+            continue
+        titles.add(recipe.title)
+        recipes[index] = recipe
+    # all titles checked in one query instead of one per recipe
+    existing = await Database.recipes_async().find_list(
+        {'title': {'$in': [recipe.title for recipe in recipes.values()]}}, projection={'_id': False, 'title': True})
+    existing = {recipe['title'] for recipe in existing}
+    for index in [index for index, recipe in recipes.items() if recipe.title in existing]:
+        del recipes[index]
+        results[index].update(status=200, message='recipe already exists')
+    recipe_ids = await Database.run(lambda: [Database.get_free_id(Database.recipes_collection(), 'recipe_id')
+                                             for _ in recipes])
+    for recipe, recipe_id in zip(recipes.values(), recipe_ids):
+        recipe.recipe_id = recipe_id
+    indexes = list(recipes)
+    failed = {}
+    if indexes:
+        try:
+            await Database.recipes_async().insert_many([recipes[index].__dict__ for index in indexes], ordered=False)
+        except BulkWriteError as e:  # e.g. a title taken by a concurrent request, the others are inserted
+            failed = {indexes[error['index']]: error for error in e.details['writeErrors']}
+        except Exception as e:
+            print(e)
+            return json_response({
+                'name': 'Something went wrong',
+                'message': 'error when adding recipes to db: run.py -> recipe_create_batch'
+            }, status=500)
+    for index, error in failed.items():
+        del recipes[index]
+        if error['code'] == 11000:
+            results[index].update(status=200, message='recipe already exists')
+        else:
+            results[index].update(status=500, message='recipe not inserted')
+    if recipes:
+        created_ids = [recipe.recipe_id for recipe in recipes.values()]
+        try:
+            await user.add_recipes(created_ids)  # one update of the author for the whole batch
+        except DatabaseUpdateException:
+            await Database.recipes_async().delete_many({'recipe_id': {'$in': created_ids}})
+            return json_response({
+                'name': 'Something went wrong',
+                'message': 'error when adding recipes to db and rewriting user stats: run.py -> recipe_create_batch'
+            }, status=500)
+        recipes_changed()
+    for index, recipe in recipes.items():
+        Facets.added(recipe.__dict__)
+        results[index].update(status=201, recipe_id=recipe.recipe_id)
+    return json_response({
+        'name': 'OK',
+        'message': '{0} of {1} recipes created by user {2}'.format(len(recipes), len(items), user.nickname),
+        'created': len(recipes),
+        'collection': results,
+    }, status=200)
+
+
 @protect
 async def recipe_delete(request, session, user):
     recipe_id = int(request.match_info.get('recipe_id'))
-    recipe = Database.recipes_collection().find_one({'recipe_id': recipe_id})
-    if not recipe:
-        return web.json_response({
+    recipe = await Database.recipes_async().find_one({'recipe_id': recipe_id})
+    if not recipe or recipe.get('status') == 'deleted':
+        return json_response({
             'name': 'OK',
             'message': 'recipe doesnt exist'
         }, status=200)
     recipe = Recipe(**recipe)
     if recipe.author_id != int(session['user_id']):
-        return web.json_response({
+        return json_response({
             'name': 'Forbidden',
             'message': 'you cannot delete recipe you doesnt own'
         }, status=403)
     user = User(**user)
     try:
-        recipe.delete_recipe(user)
+        await recipe.delete_recipe(user)
     except DatabaseUpdateException:
-        return web.json_response({
+        return json_response({
             'name': 'Something went wrong',
             'message': 'error when deleting recipe or deleting it from favorites stats: run.py -> recipe_like'
         }, status=500)
-    return web.json_response({
+    recipes_changed()
+    Facets.removed(recipe.__dict__)
+    await Cascade.submit('recipe', recipe.recipe_id)
+    if recipe.image_id:
+        await ImageStore.release_async(recipe.image_id)
+    return json_response({
         'name': 'No content',
         'message': 'recipe has deleted'
     }, status=204)
@@ -256,19 +447,46 @@ async def recipe_delete(request, session, user):
 @protect
 @process_recipe_in_uri
 async def recipe_update(request, session, user, recipe):
-    data = await request.post()
-    user = User(**user)
-    if recipe.get('recipe_id') not in user.recipes:
-        return web.json_response({
+    if recipe.get('author_id') != user.get('user_id'):  # before the body is read
+        return json_response({
             'name': 'Forbidden',
             'message': 'you cannot modify recipe you doesnt own'
         }, status=403)
+    try:
+        data = await read_form(request)
+    except UploadTooLarge as e:
+        return upload_too_large(e)
+    except EncodedUpload as e:
+        return encoded_upload(e)
+    try:
+        return await update_recipe(data, User(**user), recipe)
+    finally:
+        close_form(data)
+
+
+async def update_recipe(data, user, recipe):
     recipe_options, errors = RequestValidator.recipe_options(data, user, optional_all=True)
+    if errors:
+        return RequestValidator.error_response(errors)
+    image_id = await store_recipe_image(recipe_options)
     set_recipe_options = list(map(lambda t: {t[0]: t[1]},
                                   (map(lambda option: ('$set', {option[0]: option[1]}),
                                        recipe_options.items()))))
-    Database.recipes_collection().update_one({'recipe_id': recipe.get('recipe_id')}, set_recipe_options)
-    return web.json_response({
+    if 'image_id' in recipe_options and 'image_bytes' in recipe:  # drop legacy inline image
+        set_recipe_options.append({'$unset': 'image_bytes'})
+    try:
+        await Database.recipes_async().update_one({'recipe_id': recipe.get('recipe_id')}, set_recipe_options)
+    except DuplicateKeyError:  # title of another recipe
+        if image_id:
+            await ImageStore.release_async(image_id)
+        return recipe_exists(recipe_options.get('title'))
+    recipes_changed()  # type, title or hashtags may move it between filters
+    Facets.changed(recipe, dict(recipe, **recipe_options))
+    if recipe.get('image_id') and recipe_options.get('image_id') not in [None, recipe.get('image_id')]:
+        await ImageStore.release_async(recipe.get('image_id'))
+    if image_id:
+        Thumbnails.schedule(image_id)
+    return json_response({
         'name': 'OK',
         'message': 'recipe updated'
     }, status=200)
@@ -280,15 +498,39 @@ async def recipe_like(request, session, user, recipe):
     recipe = Recipe(**recipe)
     user = User(**user)
     try:
-        user.like_recipe(recipe)
+        liked = await user.like_recipe(recipe)
     except DatabaseUpdateException:
-        return web.json_response({
+        return json_response({
             'name': 'Something went wrong',
             'message': 'error when adding recipe to liked or rewriting recipe likes or author stats: run.py -> recipe_like'
         }, status=500)
-    return web.json_response({
+    LikedSets.changed(user.user_id, recipe.recipe_id, True)
+    if liked:
+        Facets.liked(recipe.__dict__, 1)
+    return json_response({
         'name': 'OK',
-        'message': 'recipe liked',
+        'message': 'recipe liked' if liked else 'recipe already liked',
+    }, status=200)
+
+
+@protect
+@process_recipe_in_uri
+async def recipe_unlike(request, session, user, recipe):
+    recipe = Recipe(**recipe)
+    user = User(**user)
+    try:
+        like = await user.unlike_recipe(recipe)
+    except DatabaseUpdateException:
+        return json_response({
+            'name': 'Something went wrong',
+            'message': 'error when removing recipe from liked or rewriting recipe likes or author stats: run.py -> recipe_unlike'
+        }, status=500)
+    LikedSets.changed(user.user_id, recipe.recipe_id, False)
+    if like:
+        Facets.liked(recipe.__dict__, -1, like.get('date') or 0)
+    return json_response({
+        'name': 'OK',
+        'message': 'recipe unliked' if like else 'recipe was not liked',
     }, status=200)
 
 
@@ -296,35 +538,115 @@ async def recipe_like(request, session, user, recipe):
 @process_recipe_in_uri
 async def get_recipe(request, session, user, recipe):
     projection = ['author', 'author_id', 'recipe_id', 'date', 'title', 'description', 'status', 'hashtags',
-                  'likes', 'likes_total', 'type', 'image_bytes', 'steps']
+                  'likes_total', 'type', 'steps']
     recipe_reduced = dict(filter(lambda item: item[0] in projection, recipe.items()))
     recipe_reduced.update({'user_status': user.get('status')})
-    recipe_reduced['image_base64_encoded_bytes'] = base64.encodebytes(
-        recipe_reduced['image_bytes']).decode('utf-8').replace('\n', '') if recipe_reduced['image_bytes'] else None
-    del recipe_reduced['image_bytes']
+    recipe_reduced['liked_by_me'] = bool(await LikedSets.liked(user.get('user_id'), [recipe.get('recipe_id')]))
+    recipe_reduced['image'] = ImageStore.image_reference(recipe)
     response = {
         'name': 'OK',
         'message': 'recipe complete data'
     }
     response.update(recipe_reduced)
-    return web.json_response(response, status=200)
+    return json_response(response, status=200)
+
+
+@protect
+@process_recipe_in_uri
+async def recipe_image(request, session, user, recipe):
+    query, errors = schema.query(r'/recipes/{recipe_id:\d+}/image', 'get')(request.query)
+    if errors:
+        return RequestValidator.error_response(errors)
+    size = query.get('size')
+    if recipe.get('image_id') and size in (recipe.get('thumbnails') or []):
+        etag = ImageStore.thumbnail_id(recipe.get('image_id'), size)
+        image = await ImageStore.open_async(etag)
+    elif recipe.get('image_id'):
+        image = await ImageStore.open_async(recipe.get('image_id'))
+        etag = recipe.get('image_id')
+    elif recipe.get('image_bytes'):  # recipes stored before the image store
+        image = io.BytesIO(recipe.get('image_bytes'))
+        etag = hashlib.sha256(recipe.get('image_bytes')).hexdigest()
+    else:
+        image = None
+    if not image:
+        return json_response({
+            'name': 'Not found',
+            'message': 'recipe has no image'
+        }, status=404)
+    etag = '"{0}"'.format(etag)
+    length = len(recipe.get('image_bytes')) if type(image) is io.BytesIO else image.length
+    headers = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=86400',
+    }
+    if request.headers.get('If-None-Match') == etag:
+        return web.Response(status=304, headers=headers)
+    try:
+        start, end = ImageStore.parse_range(request.headers.get('Range'), length)
+    except RangeNotSatisfiable:
+        headers.update({'Content-Range': 'bytes */{0}'.format(length)})
+        return web.Response(status=416, headers=headers)
+    partial = (end - start + 1) != length
+    if partial:
+        headers.update({'Content-Range': 'bytes {0}-{1}/{2}'.format(start, end, length)})
+    headers.update({
+        'Content-Type': ImageStore.content_type(recipe.get('image_bytes')) if type(image) is io.BytesIO
+        else (image.content_type or 'application/octet-stream'),
+        'Content-Length': str(end - start + 1),
+    })
+    response = web.StreamResponse(status=206 if partial else 200, headers=headers)
+    await response.prepare(request)
+    await ImageStore.run(image.seek, start)
+    left = end - start + 1
+    while left > 0:
+        chunk = await ImageStore.run(image.read, min(left, ImageStore.CHUNK_SIZE))
+        if not chunk:
+            break
+        await response.write(chunk)
+        left -= len(chunk)
+    await response.write_eof()
+    return response
+
+
+async def store_recipe_image(recipe_options):
+    if 'image' not in recipe_options:
+        return None
+    image = recipe_options.pop('image')
+    recipe_options['image_id'] = await ImageStore.put_upload_async(image) if image else None
+    recipe_options['thumbnails'] = []
+    return recipe_options['image_id']
+
+
+def upload_too_large(error):
+    return json_response({
+        'name': 'Payload too large',
+        'message': str(error)
+    }, status=413)
+
+
+def encoded_upload(error):
+    return json_response({
+        'name': 'Bad request',
+        'message': str(error)
+    }, status=400)
 
 
 @protect
 @admin_only
 async def block_user(request, session, admin):
-    data = await request.post()
-    status, errors = RequestValidator.validate_single_string('set_status', data)
-    user = Database.users_collection().find_one({'user_id': int(request.match_info.get('user_id'))})
-    if status not in ['locked', 'active']:
-        return web.json_response({
-            'name': 'Bad request',
-            'message': 'incorrect request'
-        }, status=400)
-    Database.users_collection().update_one({'user_id': user.get('user_id')}, [{
+    values, errors = schema.form(r'/admin/block-user/{user_id:\d+}', 'post')(await request.post())
+    if errors:
+        return RequestValidator.error_response(errors)
+    status = values['set_status']
+    user = await Database.users_async().find_one({'user_id': int(request.match_info.get('user_id'))})
+    await Database.users_async().update_one({'user_id': user.get('user_id')}, [{
         '$set': {'status': status}
     }])
-    return web.json_response({
+    users_auth_cache.invalidate(user.get('user_id'))
+    Leaderboard.set_status(user.get('user_id'), status)
+    return json_response({
         'name': 'OK',
         'message': 'for user {0} set status {1}'.format(user.get('nickname'), status)
     }, status=205)
@@ -333,18 +655,17 @@ async def block_user(request, session, admin):
 @protect
 @admin_only
 async def block_recipe(request, session, admin):
-    data = await request.post()
-    status, errors = RequestValidator.validate_single_string('set_status', data)
-    recipe = Database.recipes_collection().find_one({'recipe_id': int(request.match_info.get('recipe_id'))})
-    if status not in ['locked', 'active']:
-        return web.json_response({
-            'name': 'Bad request',
-            'message': 'incorrect request'
-        }, status=400)
-    Database.recipes_collection().update_one({'recipe_id': recipe.get('recipe_id')}, [{
+    values, errors = schema.form(r'/admin/block-recipe/{recipe_id:\d+}', 'post')(await request.post())
+    if errors:
+        return RequestValidator.error_response(errors)
+    status = values['set_status']
+    recipe = await Database.recipes_async().find_one({'recipe_id': int(request.match_info.get('recipe_id'))})
+    await Database.recipes_async().update_one({'recipe_id': recipe.get('recipe_id')}, [{
         '$set': {'status': status}
     }])
-    return web.json_response({
+    recipes_changed()
+    Facets.changed(recipe, dict(recipe, status=status))
+    return json_response({
         'name': 'OK',
         'message': 'for recipe {0} set status {1}'.format(recipe.get('title'), status)
     }, status=205)
@@ -352,83 +673,306 @@ async def block_recipe(request, session, admin):
 
 @protect
 async def explore_recipes(request, session, user):
-    data = await request.post()
+    data, errors = schema.form('/recipes/explore', 'post')(await request.post())
+    query, query_errors = schema.query('/recipes/explore', 'post')(request.query)
+    if errors or query_errors:
+        return RequestValidator.error_response(errors + query_errors)
     admin = user.get('isAdmin')
-    get_from, get_to = int(request.query.get('from', '0')), int(request.query.get('to', '10'))
-    skip, limit = get_from, get_to - get_from
-    limit = limit if limit > 0 else 1
+    page_cursor = query.get('cursor')  # keyset mode if present, empty for the first page
+    with_count = query.get('count', '1') not in ['0', 'false']  # infinite scroll needs no total
+    if page_cursor is None:
+        get_from, get_to = query.get('from', 0), query.get('to', 10)
+        skip, limit = get_from, get_to - get_from
+        limit = limit if limit > 0 else 1
+        pagination = {
+            'from': get_from,
+            'to': get_to,
+        }
+    else:
+        skip, limit = 0, page_size(query)
+        pagination = {
+            'cursor': page_cursor,
+            'limit': limit,
+        }
     sort_opt, filter_opt = RequestValidator.sort_filter_options(data)
-    if not admin:  # admin can see locked
-        filter_opt.update({'status': 'active'})
-    projection = ['author', 'author_id', 'recipe_id', 'date', 'title', 'description', 'status', 'hashtags',
-                  'likes', 'likes_total', 'type',
-                  # 'image_bytes' # Too big data for search; it is better to do thumbnails TODO thumbnails
-                  # or simply do not pass megabytes of full image
-                  ]
-    cursor = Database.recipes_collection().find(
-        filter_opt,
-        projection=projection,
-        sort=sort_opt, skip=skip, limit=limit)
-    recipes_list = list(map(lambda item: dict(filter(lambda item: item[0] in projection, item.items())), cursor))
-    all_recipes_count = Database.recipes_collection().find(filter_opt, projection=projection).count()
-
-    def encode_imagebytes(recipe):
-        # recipe['image_base64_encoded_bytes'] = base64.encodebytes(
-        #     recipe['image_bytes']).decode('utf-8') if recipe['image_bytes'] else None
-        # del recipe['image_bytes']
-        pass
-    map(encode_imagebytes, recipes_list)
-    return web.json_response({
+    # admin can see locked; $in instead of no status keeps the status-prefixed indexes usable
+    filter_opt.update({'status': 'active' if not admin else {'$in': ['active', 'locked']}})
+    author_tokens = RequestValidator.search_tokens('author_filter', data)
+    response_key = filter_key({'sort': sort_opt, 'filter': filter_opt, 'authors': author_tokens,
+                               'pagination': pagination, 'skip': skip, 'count': with_count, 'admin': bool(admin)})
+    cached = explore_cache.get(response_key)
+    if cached is not None:
+        return await viewer_page(user, *cached)
+    if author_tokens:
+        filter_opt.update({'author_id': {'$in': await Search.author_ids(author_tokens)}})
+    score = RequestValidator.relevance_score(data) if sort_opt[0][0] == 'score' else None
+    cursor_opt = {}
+    if page_cursor:
+        try:
+            cursor_opt = RequestValidator.cursor_filter(page_cursor, sort_opt)
+        except ValueError as e:
+            return invalid_cursor(e)
+    projection = RECIPE_LIST_PROJECTION
+    page_limit = limit + (page_cursor is not None)  # one more to know if next page exists
+    count_key = filter_key(filter_opt)
+    all_recipes_count = recipes_count_cache.get(count_key) if with_count else None
+    # leading $match and $sort still use the indexes; relevance is scored on the first SCORED_MATCHES
+    # matched recipes only and sorted in memory, spilling to disk if it has to
+    sorted_stages = [{'$match': filter_opt}] + (
+        [{'$limit': Search.SCORED_MATCHES}, {'$addFields': {'score': score}}] if score else []) + [
+        {'$sort': SON(sort_opt)}]
+    page_stages = ([{'$match': cursor_opt}] if cursor_opt else []) + ([{'$skip': skip}] if skip else []) + [
+        {'$limit': page_limit},
+        {'$project': dict(projection, **({'score': True} if score else {}))},
+    ]
+    head = {
         'name': 'OK',
         'message': 'list of filtered and sorted recipes{0}'.format(
             '; (if you are admin you can see locked)' if admin else ''),
-        'collection': recipes_list,
-        'total_recipes_count': all_recipes_count,
-        'pagination': {
-            'from': get_from,
-            'to': get_to,
-        },
-    }, status=200)
+    }
+    if limit > STREAM_PAGE_SIZE:
+        # big pages are written while read from mongo and not cached
+        if with_count and all_recipes_count is None:
+            all_recipes_count = await Database.recipes_async().count_documents(filter_opt)
+            recipes_count_cache.set(count_key, all_recipes_count)
+        if score:
+            documents = Database.recipes_async().iterate('aggregate', sorted_stages + page_stages, allowDiskUse=True)
+        else:
+            documents = Database.recipes_async().iterate(
+                'find', dict(filter_opt, **cursor_opt), projection=projection,
+                sort=sort_opt, skip=skip, limit=page_limit)
+        tail = {'total_recipes_count': all_recipes_count, 'pagination': pagination}
+        if page_cursor is not None:
+            tail['next_cursor'] = None
+
+        async def page():
+            done, next_cursor = 0, None
+            async for item in documents:
+                done += 1
+                if done > limit:  # the one more read: a next page exists
+                    tail['next_cursor'] = next_cursor
+                    continue
+                if done == limit and page_cursor is not None:  # before explore_item drops the score
+                    next_cursor = RequestValidator.encode_cursor(sort_opt, item)
+                yield explore_item(item)
+        return await stream_collection(request, head, LikedSets.mark(user.get('user_id'), page()), lambda: tail)
+    if score:
+        page_query = Database.recipes_async().aggregate_list(sorted_stages + page_stages, allowDiskUse=True)
+    else:
+        page_query = Database.recipes_async().find_list(
+            dict(filter_opt, **cursor_opt), projection=projection,
+            sort=sort_opt, skip=skip, limit=page_limit)
+    if with_count and all_recipes_count is None:
+        # counted alongside the page; count_documents reads the status-prefixed indexes alone where a
+        # $count after the page's $sort would fetch every matched recipe
+        cursor, all_recipes_count = await asyncio.gather(
+            page_query, Database.recipes_async().count_documents(filter_opt))
+        recipes_count_cache.set(count_key, all_recipes_count)
+    else:
+        cursor = await page_query
+    response = dict(head, total_recipes_count=all_recipes_count, pagination=pagination)
+    if page_cursor is not None:
+        response['next_cursor'] = RequestValidator.encode_cursor(sort_opt, cursor[limit - 1]) \
+            if len(cursor) > limit else None
+    items = [explore_item(item) for item in cursor[:limit]]
+    # cached for every viewer without liked_by_me, which is added per request
+    page = (page_parts(response, items), [item['recipe_id'] for item in items])
+    explore_cache.set(response_key, page, EXPLORE_LIKES_TTL if sort_opt[0][0] == 'likes_total' else None)
+    return await viewer_page(user, *page)
+
+
+async def viewer_page(user, parts, recipe_ids):
+    liked = await LikedSets.liked(user.get('user_id'), recipe_ids)
+    body = join_page(parts, [{'liked_by_me': recipe_id in liked} for recipe_id in recipe_ids])
+    return web.Response(body=body, status=200, content_type='application/json')
+
+
+# only listed fields come back from mongo, so documents of recipe lists are sent as they are
+RECIPE_LIST_PROJECTION = dict(dict.fromkeys(['author', 'author_id', 'recipe_id', 'date', 'title', 'description',
+                                             'status', 'hashtags', 'likes_total', 'type', 'thumbnails'], True),
+                              _id=False)
+
+
+def explore_item(item):
+    item.pop('score', None)
+    item['thumbnails'] = ImageStore.thumbnail_references(item)
+    return item
+
+
+def page_size(query, default=10):
+    return max(1, min(query.get('limit', default), 100))
+
+
+def invalid_cursor(error):
+    return json_response({
+        'name': 'Bad request',
+        'message': str(error)
+    }, status=400)
 
 
 @protect
-async def user_favorites(request, session, current_user):
-    projection = ['author', 'author_id', 'recipe_id', 'date', 'title', 'description', 'status', 'hashtags',
-                  'likes', 'likes_total', 'type']
-    user = Database.users_collection().find_one({'user_id': int(request.match_info.get('user_id'))})
-    opts = {'recipe_id': {'$in': user.get('favorites')}}
-    if not current_user.get('isAdmin'):
-        opts.update({'status': 'active'})
-    recipes = list(Database.recipes_collection().find(opts, projection=projection))
-    recipes_reduced = list(map(
-        lambda item: dict(filter(lambda item: item[0] in projection, item.items())), recipes))
-    return web.json_response({
+async def recipe_facets(request, session, user):
+    query, errors = schema.query('/recipes/facets', 'get')(request.query)
+    if errors:
+        return RequestValidator.error_response(errors)
+    return json_response(dict({
+        'name': 'OK',
+        'message': 'recipes per hashtag and type, hashtags trending by recent likes',
+    }, **Facets.top(page_size(query, 20))), status=200)
+
+
+@protect
+@process_user_in_uri
+async def user_favorites(request, session, current_user, user):
+    query, errors = schema.query(r'/profile/{user_id:\d+}/favorites', 'get')(request.query)
+    if errors:
+        return RequestValidator.error_response(errors)
+    limit = page_size(query)
+    direction = {'date_descending': pymongo.DESCENDING, 'date_ascending': pymongo.ASCENDING}[
+        query.get('sort_by', 'date_descending')]
+    # keyset over the (user_id, date, recipe_id) likes index: a page costs the same for any number of favorites
+    sort_opt = [('date', direction), ('recipe_id', direction)]
+    likes_opt = {'user_id': user.get('user_id')}
+    if query.get('cursor'):
+        try:
+            likes_opt.update(RequestValidator.cursor_filter(query['cursor'], sort_opt))
+        except ValueError as e:
+            return invalid_cursor(e)
+    likes = await Database.likes_async().find_list(
+        likes_opt, projection={'_id': False, 'recipe_id': True, 'date': True}, sort=sort_opt, limit=limit + 1)
+    recipe_ids = [like['recipe_id'] for like in likes[:limit]]
+    recipes_opt = {'recipe_id': {'$in': recipe_ids},
+                   'status': 'active' if not current_user.get('isAdmin') else {'$in': ['active', 'locked']}}
+    recipes = await Database.recipes_async().find_list(recipes_opt, projection=RECIPE_LIST_PROJECTION)
+    recipes = {recipe['recipe_id']: explore_item(recipe) for recipe in recipes}
+    return json_response({
         'name': 'OK',
         'message': 'list of favorites recipes of user {0}'.format(user.get('nickname')),
-        'collection': recipes_reduced,
+        'next_cursor': RequestValidator.encode_cursor(sort_opt, likes[limit - 1]) if len(likes) > limit else None,
+        'collection': await LikedSets.marked(current_user.get('user_id'),
+                                             [recipes[recipe_id] for recipe_id in recipe_ids if recipe_id in recipes]),
+    }, status=200)
+
+
+@protect
+@process_user_in_uri
+async def user_recipes(request, session, current_user, user):
+    query, errors = schema.query(r'/profile/{user_id:\d+}/recipes', 'get')(request.query)
+    if errors:
+        return RequestValidator.error_response(errors)
+    limit = page_size(query)
+    sort_opt, _ = RequestValidator.sort_filter_options({'sort_by': query.get('sort_by', 'date_descending')})
+    # served by the (author_id, status, sort..., recipe_id) indexes
+    recipes_opt = {'author_id': user.get('user_id'),
+                   'status': 'active' if not current_user.get('isAdmin') else {'$in': ['active', 'locked']}}
+    if query.get('cursor'):
+        try:
+            recipes_opt.update(RequestValidator.cursor_filter(query['cursor'], sort_opt))
+        except ValueError as e:
+            return invalid_cursor(e)
+    recipes = await Database.recipes_async().find_list(
+        recipes_opt, projection=RECIPE_LIST_PROJECTION, sort=sort_opt, limit=limit + 1)
+    return json_response({
+        'name': 'OK',
+        'message': 'list of recipes of user {0}'.format(user.get('nickname')),
+        'recipes_total': user.get('recipes_total'),
+        'next_cursor': RequestValidator.encode_cursor(sort_opt, recipes[limit - 1]) if len(recipes) > limit else None,
+        'collection': await LikedSets.marked(current_user.get('user_id'),
+                                             [explore_item(recipe) for recipe in recipes[:limit]]),
+    }, status=200)
+
+
+@protect
+@process_recipe_in_uri
+async def recipe_likers(request, session, user, recipe):
+    query, errors = schema.query(r'/recipes/{recipe_id:\d+}/likers', 'get')(request.query)
+    if errors:
+        return RequestValidator.error_response(errors)
+    limit = page_size(query, 20)
+    likes_opt = {'recipe_id': recipe.get('recipe_id')}
+    if 'cursor' in query:
+        likes_opt['user_id'] = {'$gt': query['cursor']}
+    # keyset over the (recipe_id, user_id) index, one more to know if next page exists
+    likes = await Database.likes_async().find_list(likes_opt, projection={'_id': False, 'user_id': True},
+                                                   sort=[('user_id', 1)], limit=limit + 1)
+    user_ids = [like['user_id'] for like in likes[:limit]]
+    users = await Database.users_async().find_list(
+        {'user_id': {'$in': user_ids}}, projection={'_id': False, 'user_id': True, 'nickname': True, 'status': True})
+    users = {liker['user_id']: liker for liker in users}
+    return json_response({
+        'name': 'OK',
+        'message': 'users who liked recipe {0}'.format(recipe.get('title')),
+        'likes_total': recipe.get('likes_total'),
+        'next_cursor': str(user_ids[-1]) if len(likes) > limit else None,
+        'collection': [{'user_id': user_id, 'nickname': users[user_id]['nickname']} for user_id in user_ids
+                       if user_id in users and (users[user_id].get('status') == 'active' or user.get('isAdmin'))],
     }, status=200)
 
 
 @protect
 @protect_for_user
 async def user_rename(request, session, user):
-    data = await request.post()
-    new_nickname, errors = RequestValidator.validate_single_string('new_nickname', data)
+    values, errors = schema.form(r'/profile/{user_id:\d+}/rename', 'post')(await request.post())
     if errors:
         return RequestValidator.error_response(errors)
-    Database.users_collection().update_one({'user_id': user.get('user_id')}, [
-        {'$set': {'nickname': new_nickname}}
-    ])
-    return web.json_response({
+    new_nickname = values['new_nickname']
+    try:
+        await Database.users_async().update_one({'user_id': user.get('user_id')}, [
+            {'$set': {'nickname': new_nickname, 'nickname_tokens': tokenize(new_nickname)}}
+        ])
+    except DuplicateKeyError:  # nickname of another user
+        return user_exists(new_nickname)
+    users_auth_cache.invalidate(user.get('user_id'))
+    Leaderboard.update(user.get('user_id'), nickname=new_nickname)
+    return json_response({
         'name': 'Reset content',
         'message': 'new nickname set',
     }, status=205)
 
 
+@protect
+@admin_only
+async def counters_state(request, session, admin):
+    counter_buffer = Database.counter_buffer()
+    return json_response({
+        'name': 'OK',
+        'message': 'write-behind counters state',
+        'pending_documents': counter_buffer.pending(),
+        'flush_lag': counter_buffer.lag(),
+        'flush_interval': counter_buffer.interval,
+        'last_flush_duration': counter_buffer.last_flush_duration,
+        'flushes': counter_buffer.flushes,
+    }, status=200)
+
+
+@protect
+@admin_only
+async def caches_state(request, session, admin):
+    return json_response({
+        'name': 'OK',
+        'message': 'in-process caches of this worker',
+        'explore': explore_cache.stats(),
+        'recipes_count': recipes_count_cache.stats(),
+        'users_auth': users_auth_cache.stats(),
+        'liked_sets': LikedSets.stats(),
+    }, status=200)
+
+
+@protect
+@admin_only
+async def cascades_state(request, session, admin):
+    jobs = await Cascade.run(Cascade.jobs, 50)
+    for job in jobs:
+        job['job_id'] = str(job.pop('_id'))
+    return json_response({
+        'name': 'OK',
+        'message': 'running and recent deletion cascades',
+        'collection': jobs,
+    }, status=200)
+
+
 async def hello(request):
-    print(request)
-    with open('./spec.json') as fp:
-        return web.json_response(json.load(fp))
+    return json_response(schema.SPEC)
 
 
 async def favicon(request):
@@ -450,16 +994,30 @@ def no_cache(handler):
     return new_handler
 
 
-async def make_app():
-    app = web.Application()
-    fernet_key = fernet.Fernet.generate_key()
-    secret_key = base64.urlsafe_b64decode(fernet_key)
-    aiohttp_session.setup(app, EncryptedCookieStorage(secret_key, max_age=3600))
+SHUTDOWN_TIMEOUT = float(os.environ.get('RS_SHUTDOWN_TIMEOUT', '30'))
+
+
+async def prepare_database():
+    """indexes and the admin account; the unique nickname index lets only one of concurrent starts create it"""
+    await Database.run(apply_indexes)
+    if os.environ.get('RS_NO_ADMIN'):
+        return
     admin = User(nickname=os.environ.get('RS_ADMIN_NAME', 'admin'),
                  password=os.environ.get('RS_ADMIN_PASSWORD', 'admin'))
     admin.isAdmin = True
-    if not Database.users_collection().find_one({'nickname': admin.nickname}):
-        Database.users_collection().insert_one(admin.__dict__)
+    if not await Database.users_async().find_one({'nickname': admin.nickname}):
+        try:
+            await admin.save()
+        except DuplicateKeyError:
+            pass
+
+
+async def make_app(prepare=True, metrics_port=None):
+    """metrics_port: /metrics is served there instead of on the port shared by the workers"""
+    app = web.Application(middlewares=[metrics_middleware])
+    aiohttp_session.setup(app, session_storage(max_age=3600))
+    if prepare:
+        await prepare_database()
     app.add_routes([
         web.get('/', no_cache(hello)),
         web.get('/favicon.ico', favicon),
@@ -470,17 +1028,103 @@ async def make_app():
         web.get(r'/profile/{user_id:\d+}', no_cache(user_profile)),
         web.post(r'/profile/{user_id:\d+}/rename', user_rename),
         web.get(r'/profile/{user_id:\d+}/favorites', no_cache(user_favorites)),
+        web.get(r'/profile/{user_id:\d+}/recipes', no_cache(user_recipes)),
         web.get(r'/recipes/{recipe_id:\d+}', no_cache(get_recipe)),
+        web.get(r'/recipes/{recipe_id:\d+}/image', recipe_image),
         web.post('/peoples', explore_peoples),
         web.put('/recipes/create', recipe_create),
+        web.put('/recipes/create-batch', recipe_create_batch),
         web.post('/recipes/explore', explore_recipes),
+        web.get('/recipes/facets', recipe_facets),
         web.delete(r'/recipes/{recipe_id:\d+}/delete', recipe_delete),
         web.put(r'/recipes/{recipe_id:\d+}/update', recipe_update),
         web.post(r'/recipes/{recipe_id:\d+}/like', recipe_like),
+        web.post(r'/recipes/{recipe_id:\d+}/unlike', recipe_unlike),
+        web.get(r'/recipes/{recipe_id:\d+}/likers', no_cache(recipe_likers)),
         web.post(r'/admin/block-user/{user_id:\d+}', block_user),
         web.post(r'/admin/block-recipe/{recipe_id:\d+}', block_recipe),
+        web.get('/admin/counters', no_cache(counters_state)),
+        web.get('/admin/cascades', no_cache(cascades_state)),
+        web.get('/admin/caches', no_cache(caches_state)),
     ])
+    if metrics_port is None:
+        app.add_routes([web.get('/metrics', metrics)])
+    else:
+        app['metrics_port'] = metrics_port
+        app.on_startup.append(start_metrics)
+        app.on_cleanup.append(stop_metrics)
+    app.on_startup.append(resume_jobs)
+    app.on_cleanup.append(close_database)
     return app
 
+
+async def start_metrics(app):
+    app['metrics_runner'] = await serve_metrics(app['metrics_port'])
+
+
+async def stop_metrics(app):
+    await app['metrics_runner'].cleanup()
+
+
+async def resume_jobs(app):
+    await Cascade.start()
+    await Leaderboard.start()
+    await Facets.start()
+
+
+async def close_database(app):
+    await Cascade.shutdown()
+    await Leaderboard.shutdown()
+    await Facets.shutdown()
+    await Thumbnails.shutdown()
+    await Database.counter_buffer().close()
+    Database.shutdown()
+
+
+def run_worker(port, metrics_port):
+    # SO_REUSEPORT: every worker listens on the port itself and the kernel spreads connections
+    web.run_app(make_app(prepare=False, metrics_port=metrics_port), port=port, reuse_port=True,
+                shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+
+def serve(port, workers):
+    if workers <= 1:
+        web.run_app(make_app(), port=port, shutdown_timeout=SHUTDOWN_TIMEOUT)
+        return
+    asyncio.get_event_loop().run_until_complete(prepare_database())  # once, before any worker starts
+    Database.shutdown()
+    if not load_keys():  # workers must share a key to accept each other's sessions
+        print('no RS_SESSION_KEYS or RS_SESSION_KEY_FILE, sessions end on restart and are not shared between hosts')
+        os.environ['RS_SESSION_KEYS'] = fernet.Fernet.generate_key().decode()
+    context = multiprocessing.get_context('spawn')  # no fork of a process with mongo threads
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    signal.signal(signal.SIGINT, lambda *args: stopping.append(True))
+    # a scrape of the shared port would reach any worker, so worker n serves /metrics on metrics_port + n
+    metrics_port = int(os.environ.get('RS_METRICS_PORT', str(port + 1)))
+    processes = {}  # worker number -> process, a restarted worker keeps the number and so its metrics port
+    while not stopping:
+        for worker, process in list(processes.items()):
+            if not process.is_alive():
+                print('worker {0} exited with {1}, restarting'.format(process.pid, process.exitcode))
+                del processes[worker]
+                time.sleep(1)
+        for worker in range(workers):
+            if worker not in processes and not stopping:
+                processes[worker] = context.Process(target=run_worker, args=(port, metrics_port + worker), daemon=False)
+                processes[worker].start()
+        multiprocessing.connection.wait([process.sentinel for process in processes.values()], timeout=1)
+    # SIGTERM makes each worker stop accepting, finish requests and run its cleanup
+    for process in processes.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT + 10
+    for process in processes.values():
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            print('worker {0} did not stop in time, killing it'.format(process.pid))
+            process.kill()
+
+
 if __name__ == '__main__':
-    web.run_app(make_app(), port=8100)
+    serve(int(os.environ.get('RS_PORT', '8100')), int(os.environ.get('RS_WORKERS', '1')))
@@ -0,0 +1,154 @@
+# encoding: utf-8
+import os
+import json
+
+SPEC_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spec.json')
+NUMBERED = '\\d+'  # field name suffix of numbered fields, e.g. recipe_step_\d+ for recipe_step_1, recipe_step_2...
+DIGITS = '0123456789'
+LISTED_NUMBERS = 100  # names of numbered fields up to this number are looked up directly, further ones parsed
+
+
+def text(value):
+    if value.__class__ is str:
+        return value
+    if value.__class__ is bytes or value.__class__ is bytearray:
+        return value.decode('utf-8')
+    raise ValueError('must be text')
+
+
+def converter(spec):
+    """function checking and converting one occurrence of the field, ValueError with the message if it
+    is not valid; None if the value is taken as it is"""
+    kind, max_length = spec.get('type', 'string'), spec.get('max_length')
+    if spec.get('format') == 'bytes' or kind in ['array', 'object']:
+        return None
+    if kind == 'bool':
+        return bool
+    if kind == 'integer':
+        def convert(value):
+            try:
+                return int(text(value))
+            except ValueError:
+                raise ValueError('must be an integer')
+        return convert
+    if isinstance(kind, list):
+        choices, message = frozenset(kind), 'must be one of {0}'.format(', '.join(kind))
+
+        def convert(value):
+            if value.__class__ is not str:
+                value = text(value)
+            if value not in choices:
+                raise ValueError(message)
+            return value
+        return convert
+    if max_length is not None:
+        message = 'must be at most {0} characters'.format(max_length)
+
+        def convert(value):
+            if value.__class__ is not str:
+                value = text(value)
+            if len(value) > max_length:
+                raise ValueError(message)
+            return value
+        return convert
+    return text
+
+
+class Field:
+    """one form or query parameter of spec.json: type is string, integer, bool or a list of allowed
+    values; multiple collects every occurrence into a list, as do numbered fields, in number order"""
+    __slots__ = ['numbered', 'prefix', 'name', 'multiple', 'required', 'skip_empty', 'convert']
+
+    def __init__(self, name, spec):
+        self.numbered = name.endswith(NUMBERED)
+        self.prefix = name[:-len(NUMBERED)] if self.numbered else name
+        self.name = self.prefix.rstrip('_') if self.numbered else name  # key of the value
+        self.multiple = spec.get('multiple', False) or self.numbered
+        self.required = spec.get('required', False)
+        # an empty occurrence is not sent, except for a single text field, e.g. the empty cursor of explore
+        self.skip_empty = self.multiple or spec.get('type', 'string') != 'string' or 'format' in spec
+        self.convert = converter(spec)
+
+
+class Schema:
+    """Validator of the form or query of one endpoint, compiled from spec.json once: called with a
+    MultiDict it goes over the sent fields once and returns (values, errors). values has one key per sent
+    field (a list for multiple ones), errors is the list RequestValidator.error_response takes; fields
+    absent from the spec are ignored"""
+
+    def __init__(self, fields):
+        self.fields = {}  # sent name -> (field, number of a numbered field)
+        for field in fields:
+            if field.numbered:
+                self.fields.update((field.prefix + str(number), (field, number))
+                                   for number in range(1, LISTED_NUMBERS + 1))
+            else:
+                self.fields[field.name] = (field, None)
+        self.numbered = {field.prefix: field for field in fields if field.numbered}
+        self.required = [field for field in fields if field.required]
+
+    def __call__(self, data):
+        values, errors, numbered = {}, [], {}
+        fields = self.fields
+        for key, value in data.items():
+            known = fields.get(key)
+            if known is not None:
+                field, number = known
+            else:
+                field = self.numbered.get(key.rstrip(DIGITS)) if self.numbered else None
+                if field is None or key == field.prefix:
+                    continue
+                number = int(key[len(field.prefix):])
+            if not value and field.skip_empty:
+                continue
+            convert = field.convert
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except ValueError as e:
+                    errors.append({'field': key, 'message': '{0} {1}'.format(key, e)})
+                    continue
+            if number is not None:
+                numbered.setdefault(field, {})[number] = value
+            elif field.multiple:
+                values.setdefault(field.name, []).append(value)
+            elif field.name not in values:  # the first one, as MultiDict.get
+                values[field.name] = value
+        for field, by_number in numbered.items():
+            values[field.name] = items = []
+            while len(items) + 1 in by_number:  # from 1 up to the first missing number
+                items.append(by_number[len(items) + 1])
+        for field in self.required:
+            if not values.get(field.name) and not any(error['field'].startswith(field.prefix) for error in errors):
+                name = field.prefix + '1' if field.numbered else field.name
+                errors.append({'field': name, 'message': 'you must fill {0} field'.format(name)})
+        return values, errors
+
+
+def load_spec(path=SPEC_FILE):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def compile_spec(spec):
+    """(path, method, 'parameters' or 'query') -> Schema of every endpoint"""
+    schemas = {}
+    for path, endpoint in spec['info']['paths'].items():
+        for method in endpoint.get('methods', []):
+            for section in ['parameters', 'query']:
+                schemas[(path, method, section)] = Schema([
+                    Field(name, field) for name, field in (endpoint.get(section) or {}).items()])
+    return schemas
+
+
+SPEC = load_spec()
+SCHEMAS = compile_spec(SPEC)
+
+
+def form(path, method):
+    """schema of the body fields of an endpoint, path as in spec.json and the route"""
+    return SCHEMAS[(path, method, 'parameters')]
+
+
+def query(path, method):
+    return SCHEMAS[(path, method, 'query')]
@@ -0,0 +1,46 @@
+# encoding: utf-8
+import os
+import argparse
+from pymongo import UpdateOne
+from models import Database, tokenize
+from validator import RequestValidator
+
+
+class Search:
+    AUTHOR_MATCHES = int(os.environ.get('RS_AUTHOR_MATCHES', '1000'))
+    SCORED_MATCHES = int(os.environ.get('RS_SEARCH_SCORED_MATCHES', '10000'))  # title matches ranked by relevance
+
+    @staticmethod
+    async def author_ids(tokens):
+        """ids of users whose nickname words start with every token, for author_filter"""
+        users = await Database.users_async().find_list(
+            {'nickname_tokens': RequestValidator.prefix_match(tokens)},
+            projection=['user_id'], limit=Search.AUTHOR_MATCHES)
+        return [user['user_id'] for user in users]
+
+
+def backfill(batch_size):
+    """sets title_tokens and nickname_tokens on documents created before search"""
+    for collection, id_field, text_field in [(Database.recipes_collection(), 'recipe_id', 'title'),
+                                             (Database.users_collection(), 'user_id', 'nickname')]:
+        tokens_field = text_field + '_tokens'
+        done = 0
+        while True:
+            batch = list(collection.find({tokens_field: {'$exists': False}},
+                                         projection=[id_field, text_field], limit=batch_size))
+            if not batch:
+                break
+            collection.bulk_write([
+                UpdateOne({id_field: document[id_field]},
+                          {'$set': {tokens_field: tokenize(document.get(text_field))}})
+                for document in batch], ordered=False)
+            done += len(batch)
+            print('{0}: {1} documents tokenized'.format(collection.name, done))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='title and nickname search')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    backfill(args.batch_size)
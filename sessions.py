@@ -0,0 +1,92 @@
+# encoding: utf-8
+import os
+import time
+import argparse
+from cryptography import fernet
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
+
+KEY_FILE = os.environ.get('RS_SESSION_KEY_FILE')
+RELOAD_INTERVAL = 10
+
+
+def load_keys():
+    """fernet keys, newest first, from RS_SESSION_KEYS (comma separated) or RS_SESSION_KEY_FILE (one per line)"""
+    if os.environ.get('RS_SESSION_KEYS'):
+        return [key.strip().encode() for key in os.environ['RS_SESSION_KEYS'].split(',') if key.strip()]
+    if KEY_FILE and os.path.exists(KEY_FILE):
+        with open(KEY_FILE) as fp:
+            return [line.strip().encode() for line in fp if line.strip() and not line.startswith('#')]
+    return []
+
+
+class RotatingCookieStorage(EncryptedCookieStorage):
+    """Encrypts sessions with the newest key and accepts cookies made with any listed key, so every
+    process and host given the same keys shares sessions; the key file is re-read when it changes"""
+
+    def __init__(self, keys, **kwargs):
+        super().__init__(fernet.Fernet(keys[0]), **kwargs)
+        self._fernet = fernet.MultiFernet([fernet.Fernet(key) for key in keys])
+        self._key_file_mtime = self._file_mtime()
+        self._checked = time.monotonic()
+
+    @staticmethod
+    def _file_mtime():
+        return os.path.getmtime(KEY_FILE) if KEY_FILE and os.path.exists(KEY_FILE) else None
+
+    def _reload(self):
+        if time.monotonic() - self._checked < RELOAD_INTERVAL:
+            return
+        self._checked = time.monotonic()
+        mtime = self._file_mtime()
+        if mtime == self._key_file_mtime:
+            return
+        try:
+            keys = load_keys()
+            if keys:
+                self._fernet = fernet.MultiFernet([fernet.Fernet(key) for key in keys])
+                self._key_file_mtime = mtime
+        except (OSError, ValueError) as e:  # half written or broken file, keep the current keys
+            print('session keys not reloaded: {0}'.format(e))
+
+    async def load_session(self, request):
+        self._reload()
+        return await super().load_session(request)
+
+    async def save_session(self, request, response, session):
+        self._reload()
+        return await super().save_session(request, response, session)
+
+
+def session_storage(max_age):
+    keys = load_keys()
+    if not keys:  # sessions end with the process and are not shared with other ones
+        keys = [fernet.Fernet.generate_key()]
+    return RotatingCookieStorage(keys, max_age=max_age)
+
+
+def rotate(key_file, keep):
+    """puts a new key first in key_file, keeping the keep - 1 previous ones to read older cookies"""
+    keys = []
+    if os.path.exists(key_file):
+        with open(key_file) as fp:
+            keys = [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+    keys = [fernet.Fernet.generate_key().decode()] + keys[:keep - 1]
+    temporary = key_file + '.tmp'
+    with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+        fp.write('\n'.join(keys) + '\n')
+    os.replace(temporary, key_file)  # readers see the old or the new file, never a partial one
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='session cookie keys')
+    parser.add_argument('command', choices=['generate', 'rotate'],
+                        help='generate: print a new key; rotate: add a new key to the key file')
+    parser.add_argument('--key-file', default=KEY_FILE)
+    parser.add_argument('--keep', type=int, default=2, help='keys left in the file after rotate')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        print(fernet.Fernet.generate_key().decode())
+    elif not args.key_file:
+        parser.error('rotate needs --key-file or RS_SESSION_KEY_FILE')
+    else:
+        rotate(args.key_file, max(args.keep, 1))
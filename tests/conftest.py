@@ -0,0 +1,6 @@
+# encoding: utf-8
+import os
+import sys
+
+# the modules of the app are flat files in the project directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
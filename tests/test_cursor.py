@@ -0,0 +1,66 @@
+# encoding: utf-8
+import json
+import base64
+import pymongo
+import pytest
+from validator import RequestValidator
+
+SORT = [('likes_total', pymongo.DESCENDING), ('recipe_id', pymongo.DESCENDING)]
+
+
+def raw_cursor(payload):
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def test_round_trip():
+    cursor = RequestValidator.encode_cursor(SORT, {'likes_total': 5, 'recipe_id': 12, 'title': 'soup'})
+    assert RequestValidator.cursor_filter(cursor, SORT) == {'$or': [
+        {'likes_total': {'$lt': 5}},
+        {'likes_total': 5, 'recipe_id': {'$lt': 12}},
+    ]}
+
+
+def test_round_trip_ascending_with_missing_value():
+    sort = [('title', pymongo.ASCENDING), ('recipe_id', pymongo.ASCENDING)]
+    cursor = RequestValidator.encode_cursor(sort, {'recipe_id': 3})
+    assert RequestValidator.cursor_filter(cursor, sort) == {'$or': [
+        {'title': {'$gt': None}},
+        {'title': None, 'recipe_id': {'$gt': 3}},
+    ]}
+
+
+@pytest.mark.parametrize('cursor', [
+    raw_cursor([['likes_total', 'recipe_id'], [{'$gt': -1}, {'$exists': True}]]),
+    raw_cursor([['likes_total', 'recipe_id'], [{'$foo': 1}, 1]]),
+    raw_cursor([['likes_total', 'recipe_id'], [[1], 1]]),
+    raw_cursor([['likes_total', 'recipe_id'], 5]),
+    raw_cursor([['likes_total', 'recipe_id'], 'ab']),
+    raw_cursor([['likes_total', 'recipe_id']]),
+    raw_cursor({'likes_total': 1}),
+    raw_cursor(5),
+    'not base64 json',
+    '',
+])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError, match='invalid cursor'):
+        RequestValidator.cursor_filter(cursor, SORT)
+
+
+@pytest.mark.parametrize('payload', [
+    [['date', 'recipe_id'], [1, 2]],
+    [['likes_total', 'recipe_id'], [1]],
+    [['likes_total', 'recipe_id'], [1, 2, 3]],
+])
+def test_cursor_of_another_sort(payload):
+    with pytest.raises(ValueError, match='cursor does not match sort'):
+        RequestValidator.cursor_filter(raw_cursor(payload), SORT)
+
+
+@pytest.mark.parametrize('sort_by', ['title', 'likes', 'date_ascending', 'date_descending'])
+def test_round_trip_of_explore_sorts(sort_by):
+    sort_opts, filter_opts = RequestValidator.sort_filter_options({'sort_by': sort_by})
+    item = {'title': 'soup', 'likes_total': 3, 'date': 1622505600.5, 'recipe_id': 7}
+    clauses = RequestValidator.cursor_filter(RequestValidator.encode_cursor(sort_opts, item), sort_opts)['$or']
+    assert [list(clause) for clause in clauses] == [[key for key, direction in sort_opts[:i + 1]]
+                                                    for i in range(len(sort_opts))]
+    assert clauses[-1][sort_opts[-1][0]] == {'$gt' if sort_opts[-1][1] == 1 else '$lt': 7}
@@ -0,0 +1,105 @@
+# encoding: utf-8
+import pytest
+from multidict import MultiDict
+import schema
+
+RECIPE_CREATE = schema.form('/recipes/create', 'put')
+EXPLORE = schema.form('/recipes/explore', 'post')
+
+
+def recipe_form(*fields):
+    return MultiDict([('recipe_title', 'soup'), ('recipe_description', 'hot'), ('recipe_step_1', 'boil')] +
+                     list(fields))
+
+
+def fields_of(errors):
+    return [error['field'] for error in errors]
+
+
+def test_valid_recipe():
+    values, errors = RECIPE_CREATE(recipe_form(('recipe_type', 'soup'), ('recipe_hashtag', 'hot'),
+                                               ('recipe_hashtag', 'quick'), ('unknown', 'ignored')))
+    assert errors == []
+    assert values == {'recipe_title': 'soup', 'recipe_description': 'hot', 'recipe_step': ['boil'],
+                      'recipe_type': 'soup', 'recipe_hashtag': ['hot', 'quick']}
+
+
+def test_required_fields():
+    values, errors = RECIPE_CREATE(MultiDict([('recipe_title', 'soup')]))
+    assert sorted(fields_of(errors)) == ['recipe_description', 'recipe_step_1']
+    assert errors[0]['message'].startswith('you must fill')
+
+
+def test_empty_required_field():
+    values, errors = RECIPE_CREATE(MultiDict(
+        [('recipe_title', ''), ('recipe_description', 'hot'), ('recipe_step_1', 'boil')]))
+    assert fields_of(errors) == ['recipe_title']
+
+
+def test_max_length():
+    values, errors = RECIPE_CREATE(recipe_form(('recipe_hashtag', 'x' * 64), ('recipe_hashtag', 'x' * 65)))
+    assert fields_of(errors) == ['recipe_hashtag']
+    assert errors[0]['message'] == 'recipe_hashtag must be at most 64 characters'
+    assert values['recipe_hashtag'] == ['x' * 64]
+
+
+def test_enum():
+    values, errors = RECIPE_CREATE(recipe_form(('recipe_type', 'pie')))
+    assert fields_of(errors) == ['recipe_type']
+    assert errors[0]['message'].startswith('recipe_type must be one of first course, ')
+    assert 'recipe_type' not in values
+
+
+def test_multiple_enum():
+    values, errors = EXPLORE(MultiDict([('type_filter', 'soup'), ('type_filter', 'drink'), ('type_filter', '')]))
+    assert errors == []
+    assert values == {'type_filter': ['soup', 'drink']}
+
+
+def test_single_field_takes_first():
+    values, errors = EXPLORE(MultiDict([('sort_by', 'likes'), ('sort_by', 'title')]))
+    assert values == {'sort_by': 'likes'}
+
+
+def test_numbered_fields_in_order_up_to_first_missing():
+    values, errors = RECIPE_CREATE(recipe_form(('recipe_step_3', 'serve'), ('recipe_step_2', 'salt'),
+                                               ('recipe_step_5', 'never read'), ('recipe_step_150', 'far')))
+    assert errors == []
+    assert values['recipe_step'] == ['boil', 'salt', 'serve']
+
+
+def test_numbered_field_too_long():
+    values, errors = RECIPE_CREATE(recipe_form(('recipe_step_2', 'x' * 2001)))
+    assert fields_of(errors) == ['recipe_step_2']
+
+
+def test_bytes_are_decoded():
+    values, errors = EXPLORE(MultiDict([('title_filter', 'суп'.encode('utf-8'))]))
+    assert values == {'title_filter': 'суп'}
+
+
+@pytest.fixture
+def compiled():
+    return schema.compile_spec({'info': {'paths': {'/items': {'methods': ['get'], 'query': {
+        'limit': {'type': 'integer'},
+        'cursor': {'type': 'string'},
+        'full': {'type': 'bool'},
+    }}}}})
+
+
+def test_integer(compiled):
+    query = compiled[('/items', 'get', 'query')]
+    assert query(MultiDict([('limit', '20')])) == ({'limit': 20}, [])
+    values, errors = query(MultiDict([('limit', 'many')]))
+    assert values == {}
+    assert errors == [{'field': 'limit', 'message': 'limit must be an integer'}]
+
+
+def test_empty_values(compiled):
+    query = compiled[('/items', 'get', 'query')]
+    # an empty single text field is sent on, an empty integer or bool is left out
+    assert query(MultiDict([('cursor', ''), ('limit', ''), ('full', '')])) == ({'cursor': ''}, [])
+
+
+def test_sections_of_every_method(compiled):
+    assert compiled[('/items', 'get', 'parameters')](MultiDict([('limit', '1')])) == ({}, [])
@@ -0,0 +1,153 @@
+# encoding: utf-8
+import io
+import os
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from models import Database
+from images import ImageStore
+from cache import explore_cache
+
+
+def render_thumbnails(image_bytes, sizes):
+    # runs in a worker process: decoding and resampling hold the GIL for the whole image
+    image = Image.open(io.BytesIO(image_bytes))
+    image.draft('RGB', (max(sizes.values()), max(sizes.values())))  # cheap jpeg downscale on decode
+    if image.mode not in ['RGB', 'L']:
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    thumbnails = {}
+    for size, pixels in sizes.items():
+        thumbnail = image.copy()
+        thumbnail.thumbnail((pixels, pixels), Image.LANCZOS)
+        output = io.BytesIO()
+        thumbnail.save(output, format='JPEG', quality=80, optimize=True)
+        thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+class Thumbnails:
+    _executor = None
+    _slots = None
+    _tasks = set()
+
+    @staticmethod
+    def processes():
+        return int(os.environ.get('RS_THUMBNAIL_PROCESSES', os.cpu_count() or 1))
+
+    @staticmethod
+    def executor():
+        if not Thumbnails._executor:
+            Thumbnails._executor = ProcessPoolExecutor(
+                max_workers=Thumbnails.processes(),
+                mp_context=multiprocessing.get_context('spawn'))  # no fork of a process with mongo threads
+        return Thumbnails._executor
+
+    @staticmethod
+    def exist(image_id):
+        return all(ImageStore.fs().exists(ImageStore.thumbnail_id(image_id, size))
+                   for size in ImageStore.THUMBNAIL_SIZES)
+
+    @staticmethod
+    def store(image_id, thumbnails):
+        for size, thumbnail_bytes in thumbnails.items():
+            ImageStore.put(thumbnail_bytes, ImageStore.thumbnail_id(image_id, size))
+        Database.recipes_collection().update_many(
+            {'image_id': image_id}, {'$set': {'thumbnails': list(thumbnails)}})
+
+    @staticmethod
+    def read(image_id):
+        image = ImageStore.open(image_id)
+        return image.read() if image else None
+
+    @staticmethod
+    async def generate(image_id):
+        loop = asyncio.get_event_loop()
+        if not Thumbnails._slots:
+            Thumbnails._slots = asyncio.Semaphore(Thumbnails.processes())
+        try:
+            if await ImageStore.run(Thumbnails.exist, image_id):  # same picture uploaded before
+                await Database.recipes_async().update_many(
+                    {'image_id': image_id}, {'$set': {'thumbnails': list(ImageStore.THUMBNAIL_SIZES)}})
+                explore_cache.clear()
+                return
+            # the image is read back from the store only when a worker is free, so queued uploads take no memory
+            async with Thumbnails._slots:
+                image_bytes = await ImageStore.run(Thumbnails.read, image_id)
+                if not image_bytes:
+                    return
+                thumbnails = await loop.run_in_executor(
+                    Thumbnails.executor(), render_thumbnails, image_bytes, ImageStore.THUMBNAIL_SIZES)
+            await ImageStore.run(Thumbnails.store, image_id, thumbnails)
+            explore_cache.clear()  # cached pages were built without them
+        except Exception as e:
+            print('thumbnails for image {0} failed: {1}'.format(image_id, e))
+
+    @staticmethod
+    def schedule(image_id):
+        # the recipe is answered right away, thumbnails appear in listings once rendered
+        task = asyncio.ensure_future(Thumbnails.generate(image_id))
+        Thumbnails._tasks.add(task)
+        task.add_done_callback(Thumbnails._tasks.discard)
+
+    @staticmethod
+    async def shutdown():
+        if Thumbnails._tasks:
+            await asyncio.gather(*Thumbnails._tasks, return_exceptions=True)
+        if Thumbnails._executor:
+            Thumbnails._executor.shutdown(wait=True)
+            Thumbnails._executor = None
+
+
+def backfill(batch_size):
+    """moves inline image_bytes of old recipes into the image store and renders missing thumbnails"""
+    recipes = Database.recipes_collection()
+    done, last_recipe_id = 0, -1
+    while True:
+        batch = list(recipes.find({'recipe_id': {'$gt': last_recipe_id}, '$or': [
+            {'image_bytes': {'$type': 'binData'}},
+            {'image_id': {'$type': 'string'}, 'thumbnails': {'$not': {'$size': len(ImageStore.THUMBNAIL_SIZES)}}},
+        ]}, projection=['recipe_id', 'image_id', 'image_bytes'], sort=[('recipe_id', 1)], limit=batch_size))
+        if not batch:
+            break
+        last_recipe_id = batch[-1]['recipe_id']
+        images = {}
+        for recipe in batch:
+            if recipe.get('image_bytes'):
+                image_bytes = bytes(recipe['image_bytes'])
+                image_id = ImageStore.put(image_bytes)
+                recipes.update_one({'recipe_id': recipe['recipe_id']},
+                                   {'$set': {'image_id': image_id}, '$unset': {'image_bytes': ''}})
+                images[image_id] = image_bytes
+            elif recipe.get('image_id') not in images:
+                image = ImageStore.open(recipe['image_id'])
+                if not image:
+                    recipes.update_one({'recipe_id': recipe['recipe_id']}, {'$set': {'image_id': None}})
+                    continue
+                images[recipe['image_id']] = image.read()
+        pending = [image_id for image_id in images if not Thumbnails.exist(image_id)]
+        futures = [Thumbnails.executor().submit(render_thumbnails, images[image_id], ImageStore.THUMBNAIL_SIZES)
+                   for image_id in pending]
+        for image_id, future in zip(pending, futures):
+            try:
+                Thumbnails.store(image_id, future.result())
+            except Exception as e:  # not an image, leave it without thumbnails
+                print('thumbnails for image {0} failed: {1}'.format(image_id, e))
+        for image_id in set(images) - set(pending):
+            recipes.update_many({'image_id': image_id},
+                                {'$set': {'thumbnails': list(ImageStore.THUMBNAIL_SIZES)}})
+        done += len(batch)
+        print('processed {0} recipes'.format(done))
+    Thumbnails.executor().shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='recipe image thumbnails')
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--batch-size', type=int, default=100)
+    args = parser.parse_args()
+    backfill(args.batch_size)
@@ -0,0 +1,119 @@
+# encoding: utf-8
+import os
+import hashlib
+import tempfile
+from multidict import MultiDict
+
+MAX_BODY_SIZE = int(os.environ.get('RS_UPLOAD_MAX_SIZE', str(16 * 1024 * 1024)))
+MAX_IMAGE_SIZE = int(os.environ.get('RS_UPLOAD_IMAGE_SIZE', str(10 * 1024 * 1024)))
+MAX_FIELD_SIZE = int(os.environ.get('RS_UPLOAD_FIELD_SIZE', str(64 * 1024)))
+SPOOL_SIZE = int(os.environ.get('RS_UPLOAD_SPOOL_SIZE', str(256 * 1024)))
+FILE_FIELDS = ['recipe_image']
+# file parts are hashed and written chunk by chunk, which needs them sent as they are; browsers do so
+RAW_TRANSFER_ENCODINGS = ['binary', '8bit', '7bit']
+RAW_CONTENT_ENCODINGS = ['identity']
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, field, limit):
+        super().__init__('{0} is larger than {1} bytes'.format(field, limit))
+        self.field = field
+        self.limit = limit
+
+
+class EncodedUpload(Exception):
+    def __init__(self, field):
+        super().__init__('{0} must be sent without Content-Transfer-Encoding or Content-Encoding'.format(field))
+        self.field = field
+
+
+class UploadedFile:
+    """file part of a form, in memory up to SPOOL_SIZE and in a temporary file above; sha256 and size are
+    known once the form is read"""
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self._hash.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+
+    def head(self, size):
+        self.file.seek(0)
+        head = self.file.read(size)
+        self.file.seek(0)
+        return head
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+    def __bool__(self):
+        return self.size > 0
+
+
+def sent_raw(part):
+    return ((part.headers.get('Content-Transfer-Encoding') or 'binary').lower() in RAW_TRANSFER_ENCODINGS and
+            (part.headers.get('Content-Encoding') or 'identity').lower() in RAW_CONTENT_ENCODINGS)
+
+
+async def read_form(request):
+    """fields of a multipart/form-data or urlencoded body as a MultiDict of strings, FILE_FIELDS as UploadedFile;
+    parts are read as they arrive and UploadTooLarge is raised as soon as a limit is passed; EncodedUpload if
+    a file part is base64, quoted-printable or compressed, whose encoded units may span chunks"""
+    if request.content_length is not None and request.content_length > MAX_BODY_SIZE:
+        raise UploadTooLarge('request body', MAX_BODY_SIZE)
+    if request.content_type != 'multipart/form-data':
+        return await request.post()  # no files, bounded by the application client_max_size
+    fields, total = [], 0
+    reader = await request.multipart()
+    try:
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            is_file = part.name in FILE_FIELDS
+            if is_file and not sent_raw(part):
+                raise EncodedUpload(part.name)
+            limit = MAX_IMAGE_SIZE if is_file else MAX_FIELD_SIZE
+            value, size = UploadedFile() if is_file else bytearray(), 0
+            fields.append((part.name, value))
+            while True:
+                chunk = await part.read_chunk()
+                if not chunk:
+                    break
+                size, total = size + len(chunk), total + len(chunk)
+                if total > MAX_BODY_SIZE:
+                    raise UploadTooLarge('request body', MAX_BODY_SIZE)
+                if size > limit:
+                    raise UploadTooLarge(part.name, limit)
+                if is_file:
+                    value.write(chunk)
+                else:
+                    value.extend(chunk)
+            if not is_file:  # same values request.post() gives
+                value = part.decode(bytes(value))
+                content_type = part.headers.get('Content-Type')
+                if content_type is None or content_type.startswith('text/'):
+                    value = value.decode(part.get_charset(default='utf-8'))
+                fields[-1] = (part.name, value)
+    except BaseException:
+        close_form(MultiDict(fields))
+        raise
+    return MultiDict(fields)
+
+
+def close_form(form):
+    for value in form.values():
+        if isinstance(value, UploadedFile):
+            value.close()
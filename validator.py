@@ -1,117 +1,127 @@
 # encoding: utf-8
-from aiohttp import web
+import os
 import pymongo
 import re
+import json
+import base64
+from models import tokenize
+from responses import json_response
+from uploads import UploadedFile
+import schema
 
+RECIPE_CREATE = schema.form('/recipes/create', 'put')
+RECIPE_UPDATE = schema.form(r'/recipes/{recipe_id:\d+}/update', 'put')
+# shorter words of title_filter are left out, a one-letter prefix matches most titles and all of them get scored
+SEARCH_MIN_PREFIX = int(os.environ.get('RS_SEARCH_MIN_PREFIX', '2'))
+CURSOR_TYPES = (int, float, str, bool)  # besides None, values a keyset cursor may carry
 
-class RequestValidator:
-    @staticmethod
-    def validate_single_string(field_name, post_data, prev_errors=None, optional=False):
-        field_value = post_data.get(field_name)
-        if not field_value and not optional:
-            errors = (prev_errors or []) + [{
-                'field': field_name,
-                'message': 'you must fill {0} field'.format(field_name)
-            }]
-            return None, errors
-        if type(field_value) in [bytes, bytearray]:
-            field_value = field_value.decode('utf-8')
-        return field_value if optional else (field_value, prev_errors)
-
-    @staticmethod
-    def validate_array_string(field_name, post_data, prev_errors=None, optional=False):
-        try:
-            values = post_data.getall(field_name)
-        except KeyError:
-            if optional:
-                return []
-            else:
-                errors = (prev_errors or []) + [{
-                    'field': field_name,
-                    'message': 'you must (multiply) fill {0} field'.format(field_name)
-                }]
-                return None, errors
-        decoded_values = list(map(lambda b: (b.decode('utf-8') if type(b) in [bytes, bytearray] else b), values))
-        return decoded_values if optional else (decoded_values, prev_errors)
-
-    @staticmethod
-    def validate_recipe_steps(post_data, prev_errors=None, fields_prefix_name='recipe_step_'):
-        steps = []
-        for i in range(1, 100):
-            step_name = fields_prefix_name + str(i)
-            step_value = post_data.get(step_name)
-            if i == 1 and not step_value:  # min one step
-                errors = (prev_errors or []) + [{
-                    'field': step_name,
-                    'message': 'you must fill almost 1 recipe step field'
-                }]
-                return None, errors
-            if type(step_value) in [bytes, bytearray]:
-                steps.append(step_value.decode('utf-8'))
-            else:
-                break
-        return steps, prev_errors
 
+class RequestValidator:
     @staticmethod
     def error_response(errors):
-        return web.json_response({
+        return json_response({
             'name': 'Unprocessable entity',
             'message': 'you missed some required fields',
             'errors': errors
         }, status=422)
 
     @staticmethod
-    def sort_filter_options(post_data):
-        sort_by = post_data.get('sort_by')
-        sort_by = sort_by.decode('utf-8') if type(sort_by) in [bytes, bytearray] else sort_by
+    def sort_filter_options(values):
+        """sort and filter of explore from the values of its form schema, so sort_by is one of the spec"""
+        title_tokens = RequestValidator.title_tokens(values)
         sort_opts = {
             'title': [('title', pymongo.ASCENDING)],
             'likes': [('likes_total', pymongo.DESCENDING)],
             'date_ascending': [('date', pymongo.ASCENDING)],
             'date_descending': [('date', pymongo.DESCENDING)],
-            None: []
-        }[sort_by]
+            # by relevance_score, added to searched recipes by the handler
+            None: [('score', pymongo.DESCENDING), ('likes_total', pymongo.DESCENDING)] if title_tokens else []
+        }[values.get('sort_by')]
+        # recipe_id breaks ties, so the order is total and a keyset cursor can resume after any recipe
+        sort_opts = sort_opts + [('recipe_id', sort_opts[0][1] if sort_opts else pymongo.ASCENDING)]
         filter_opts = {}
-        filter_type = list(filter(lambda x: x, map(lambda tp: (tp.decode('utf-8') if type(tp) in [bytes, bytearray] else tp), post_data.getall('type_filter', []))))
-        if filter_type:
-            filter_opts.update({'type': {'$in': filter_type}})
-        title_filter = post_data.get('title_filter')
-        if title_filter:
-            filter_opts.update({'title': {
-                '$regex': re.compile(title_filter.decode('utf-8') if type(title_filter) in [bytes, bytearray] else title_filter, re.IGNORECASE)}})
-        author_filter = post_data.get('author_filter')
-        if author_filter:
-            filter_opts.update({'author': {
-                '$regex': re.compile(author_filter.decode('utf-8') if type(author_filter) in [bytes, bytearray] else author_filter, re.IGNORECASE)}})
-        filter_hashtags = list(filter(
-            lambda x: x, map(lambda tag: (tag.decode('utf-8') if type(tag) in [bytes, bytearray] else tag), post_data.getall('hashtag_filter', []))))
-        if filter_hashtags:
-            filter_opts.update({'hashtags': {'$in': filter_hashtags}})
-        if post_data.get('image_filter'):
-            filter_opts.update({'image_bytes': {'$ne': None}})
+        if values.get('type_filter'):
+            filter_opts.update({'type': {'$in': values['type_filter']}})
+        if title_tokens:
+            filter_opts.update({'title_tokens': RequestValidator.prefix_match(title_tokens)})
+        # author_filter needs nickname -> author_id resolution, see search.Search.author_ids
+        if values.get('hashtag_filter'):
+            filter_opts.update({'hashtags': {'$in': values['hashtag_filter']}})
+        if values.get('image_filter'):
+            filter_opts.update({'image_id': {'$type': 'string'}})
         return sort_opts, filter_opts
 
+    @staticmethod
+    def search_tokens(field_name, values):
+        return tokenize(values.get(field_name))
+
+    @staticmethod
+    def title_tokens(values):
+        return [token for token in RequestValidator.search_tokens('title_filter', values)
+                if len(token) >= SEARCH_MIN_PREFIX]
+
+    @staticmethod
+    def prefix_match(tokens):
+        # every query word must start some word of the field; anchored and escaped, so index bounds are tight
+        return {'$all': [re.compile('^' + re.escape(token)) for token in tokens]}
+
+    @staticmethod
+    def relevance_score(values):
+        """words of title_filter matched exactly, plus share of the title they cover"""
+        tokens = RequestValidator.title_tokens(values)
+        return {'$add': [
+            {'$size': {'$setIntersection': ['$title_tokens', tokens]}},
+            {'$divide': [len(tokens), {'$max': [{'$size': '$title_tokens'}, 1]}]},
+        ]}
+
+    @staticmethod
+    def encode_cursor(sort_opts, last_item):
+        keys = [key for key, direction in sort_opts]
+        return base64.urlsafe_b64encode(json.dumps([keys, [last_item.get(key) for key in keys]]).encode('utf-8')) \
+            .decode('utf-8').rstrip('=')
+
+    @staticmethod
+    def cursor_filter(cursor, sort_opts):
+        """filter for items strictly after the cursor in sort_opts order:
+        (k1 after v1) or (k1 == v1 and k2 after v2) or ...; ValueError if cursor is broken or made for another sort"""
+        try:
+            keys, values = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8') + b'=' * (-len(cursor) % 4)))
+        except Exception:
+            raise ValueError('invalid cursor')
+        # plain values only, an operator such as {"$gt": ...} must not get into the filter
+        if not isinstance(values, list) or any(value is not None and not isinstance(value, CURSOR_TYPES)
+                                               for value in values):
+            raise ValueError('invalid cursor')
+        if keys != [key for key, direction in sort_opts] or len(values) != len(keys):
+            raise ValueError('cursor does not match sort')
+        clauses = []
+        for i, (key, direction) in enumerate(sort_opts):
+            clause = dict(zip(keys[:i], values[:i]))
+            clause[key] = {'$gt' if direction == pymongo.ASCENDING else '$lt': values[i]}
+            clauses.append(clause)
+        return {'$or': clauses}
+
     @staticmethod
     def recipe_options(post_data, user, optional_all=False):
-        recipe_title, errors = RequestValidator.validate_single_string('recipe_title', post_data, [])
-        recipe_description, errors = RequestValidator.validate_single_string('recipe_description', post_data, errors)
-        recipe_steps, errors = RequestValidator.validate_recipe_steps(post_data, errors)
-        if errors and not optional_all:
+        values, errors = (RECIPE_UPDATE if optional_all else RECIPE_CREATE)(post_data)
+        if errors:
             return None, errors
-        image_bytes = post_data.get('recipe_image').file.read() if post_data.get('recipe_image') else None
+        image = values.get('recipe_image')
+        image = image if isinstance(image, UploadedFile) and image else None
         recipe_options = {
             'author_id': user.user_id,
             'author': user.nickname,
-            'hashtags': RequestValidator.validate_array_string('recipe_hashtag', post_data, [], optional=True) or [],
-            'type': RequestValidator.validate_single_string('recipe_type', post_data, optional=True) or 'other',
-            'title': recipe_title,
-            'description': recipe_description,
-            'steps': recipe_steps
+            'hashtags': values.get('recipe_hashtag', []),
+            'type': values.get('recipe_type', None if optional_all else 'other'),  # update keeps the type
+            'title': values.get('recipe_title'),
+            'title_tokens': tokenize(values.get('recipe_title')),
+            'description': values.get('recipe_description'),
+            'steps': values.get('recipe_step', [])
         }
         if optional_all:
             recipe_options = dict(filter(lambda i: i[1], recipe_options.items()))
-        if image_bytes or (not image_bytes and not optional_all):
+        if image or not optional_all:
             recipe_options.update({
-                'image_bytes': bytes(image_bytes) if image_bytes else None,
+                'image': image,
             })
         return recipe_options, errors